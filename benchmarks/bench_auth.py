@@ -0,0 +1,86 @@
+"""
+Compares evaluating pycrust.auth conditions as compiled plans against
+the plain nested closures they used to be, for a handler with a few
+dozen role and user conditions, several of them repeated.
+"""
+import json
+import types
+
+import cherrypy
+
+import common
+from common import bench
+from pycrust import auth
+
+USERS = {'bob': json.dumps({'name': 'bob', 'roles': ['staff', 'editor'],
+                            'groups': ['group%d' % i for i in range(500)]})}
+loads = [0]
+
+
+def load_roles():
+    # stands in for fetching the user record
+    loads[0] += 1
+    return set(json.loads(USERS[cherrypy.request.login])['roles'])
+
+
+## the old closures
+def closure_all_of(*conditions):
+    def check():
+        for c in conditions:
+            if not c():
+                return False
+        return True
+    return check
+
+def closure_one_of(*conditions):
+    def check():
+        for c in conditions:
+            if c():
+                return True
+        return False
+    return check
+
+def closure_user(id):
+    return lambda: cherrypy.request.login == id
+
+def closure_role(role):
+    return lambda: role in load_roles()
+
+
+def role(name):
+    return auth.Condition(lambda: name in load_roles(), key=('role', name))
+
+
+def build(all_of, one_of, user, has_role, valid_user):
+    admins = one_of(*[user('admin%d' % i) for i in range(20)])
+    return [
+        valid_user(),
+        one_of(admins, all_of(has_role('staff'), has_role('editor'))),
+        one_of(has_role('staff'), has_role('auditor')),
+        all_of(valid_user(), one_of(admins, has_role('editor'))),
+    ]
+
+
+def evaluate(conditions):
+    cherrypy.serving.request = types.SimpleNamespace(login='bob')
+    for c in conditions:
+        if not c():
+            return False
+    return True
+
+
+def main():
+    closures = build(closure_all_of, closure_one_of, closure_user, closure_role,
+                     lambda: (lambda: bool(cherrypy.request.login)))
+    compiled = build(auth.all_of, auth.one_of, auth.auth_user, role, auth.auth_valid_user)
+    plan = auth.compile_conditions(compiled)
+
+    for name, conditions in (('nested closures', closures), ('compiled plan', [plan])):
+        loads[0] = 0
+        assert evaluate(conditions)
+        print('{}: {} user loads per request'.format(name, loads[0]))
+        bench(name, lambda: evaluate(conditions))
+
+
+if __name__ == '__main__':
+    common.run(main)
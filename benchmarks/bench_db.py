@@ -0,0 +1,57 @@
+"""
+Benchmarks for the per-request overhead of SATool: a handler which
+doesn't query anything, with the tool reaching SAEnginePlugin through
+the bus, calling it directly, and with a lazy session.  Requests run
+in-process through the WSGI interface against an in-memory SQLite
+database, so the numbers are mostly the tool's own cost.
+"""
+import cherrypy
+from sqlalchemy import text
+
+import common
+from common import bench
+from bench_oauth import wsgi_get
+from pycrust.saplugin import SAEnginePlugin
+from pycrust.satool import SATool
+
+
+class Root(object):
+    @cherrypy.expose
+    def index(self):
+        return 'plain'
+
+    @cherrypy.expose
+    def query(self):
+        return str(cherrypy.request.db.execute(text('SELECT 1')).scalar())
+
+
+def main():
+    cherrypy.config.update({'environment': 'embedded', 'log.screen': False})
+    # unnamed, so that it listens on the default bus channels
+    plugin = SAEnginePlugin(cherrypy.engine, 'sqlite://')
+    plugin.subscribe()
+    plugin.start()
+
+    cherrypy.tools.db_bus = SATool()
+    cherrypy.tools.db_direct = SATool(plugin)
+    cherrypy.tree.mount(Root(), '/none')
+    cherrypy.tree.mount(Root(), '/bus', {'/': {'tools.db_bus.on': True}})
+    cherrypy.tree.mount(Root(), '/direct', {'/': {'tools.db_direct.on': True}})
+    cherrypy.tree.mount(Root(), '/lazy', {'/': {'tools.db_direct.on': True,
+                                                'tools.db_direct.lazy': True}})
+    cases = [('no tool', '/none/')]
+    for name in ('bus', 'direct', 'lazy'):
+        cases.append(('SATool {}, no query'.format(name), '/{}/'.format(name)))
+        cases.append(('SATool {}, one query'.format(name), '/{}/query'.format(name)))
+    try:
+        for name, path in cases:
+            status = wsgi_get(path)
+            assert status.startswith('200'), '{} returned {}'.format(name, status)
+            bench(name, lambda: wsgi_get(path), number=2000)
+    finally:
+        plugin.stop()
+        plugin.unsubscribe()
+
+
+if __name__ == '__main__':
+    common.run(main)
@@ -0,0 +1,56 @@
+"""
+Benchmarks for pycrust.tools JSON output: each available backend,
+with and without sorted keys, on a list of rows like a typical list
+endpoint returns; and streaming a generator of rows compared with
+encoding them all at once.
+"""
+import datetime
+
+import common
+from common import bench
+from pycrust.tools import json_backends, json_encode, json_stream
+
+
+class Row(object):
+    def __init__(self, i):
+        self.i = i
+
+    def __to_dict__(self):
+        return {
+            'id':       self.i,
+            'name':     'row {}'.format(self.i),
+            'tags':     ['a', 'b', 'c'],
+            'score':    self.i * 1.5,
+            'created':  datetime.datetime(2020, 1, 1, 12, 0, 0),
+        }
+
+
+def drain(chunks):
+    """Consumes a stream the way the server would, one chunk at a time"""
+    for chunk in chunks:
+        pass
+
+
+def main():
+    plain = [Row(i).__to_dict__() for i in range(1000)]
+    objects = [Row(i) for i in range(1000)]
+
+    for backend in sorted(json_backends):
+        for sort_keys in (True, False):
+            label = '{} {}'.format(backend, 'sorted' if sort_keys else 'unsorted')
+            bench('{}, 1000 dicts'.format(label),
+                  lambda: json_encode(plain, sort_keys, backend), number=200)
+            bench('{}, 1000 __to_dict__ objects'.format(label),
+                  lambda: json_encode(objects, sort_keys, backend), number=200)
+
+        bench('{} all at once, 2000 rows'.format(backend),
+              lambda: json_encode([Row(i).__to_dict__() for i in range(2000)], False, backend),
+              number=20)
+        for format in ('array', 'ndjson'):
+            bench('{} streamed {}, 2000 rows'.format(backend, format),
+                  lambda: drain(json_stream((Row(i).__to_dict__() for i in range(2000)),
+                                            False, backend, format)),
+                  number=20)
+
+if __name__ == '__main__':
+    common.run(main)
@@ -0,0 +1,61 @@
+"""
+Compares the cost of a nonce check through an SQL-backed data store
+(sqlite standing in for the real database) with MemoryNonceStore and
+SharedNonceStore.
+"""
+import itertools
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import common
+from common import bench
+from pycrust import oauth
+
+
+class SQLiteNonceStore(oauth.OAuthDataStore):
+    """The usual lookup_nonce(): look for the nonce, insert it if new."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS nonce '
+                        '(consumer TEXT, token TEXT, nonce TEXT, '
+                        'PRIMARY KEY (consumer, token, nonce))')
+
+    def lookup_nonce(self, oauth_consumer, oauth_token, nonce):
+        token = oauth_token.key if oauth_token else ''
+        row = self.db.execute('SELECT nonce FROM nonce WHERE consumer=? AND token=? AND nonce=?',
+                              (oauth_consumer.key, token, nonce)).fetchone()
+        if row:
+            return row[0]
+        self.db.execute('INSERT INTO nonce VALUES (?, ?, ?)', (oauth_consumer.key, token, nonce))
+        return None
+
+
+def main():
+    consumer = oauth.OAuthConsumer('consumer', 'secret')
+    token = oauth.OAuthToken('token', 'secret')
+    tmpdir = tempfile.mkdtemp()
+
+    stores = [
+        ('sqlite datastore', SQLiteNonceStore(os.path.join(tmpdir, 'nonce.db'))),
+        ('MemoryNonceStore', oauth.MemoryNonceStore(None)),
+        ('SharedNonceStore', oauth.SharedNonceStore(None, os.path.join(tmpdir, 'nonce.tbl'),
+                                                    slots=1 << 20)),
+    ]
+
+    for name, store in stores:
+        counter = itertools.count()
+        bench('{} (new nonce)'.format(name),
+              lambda: store.lookup_nonce(consumer, token, str(next(counter))),
+              number=20000, repeat=1)
+        bench('{} (replay)'.format(name),
+              lambda: store.lookup_nonce(consumer, token, '1'),
+              number=20000)
+
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    common.run(main)
@@ -0,0 +1,163 @@
+"""
+Benchmarks for the OAuth1/OAuth2 request lifecycle: parameter parsing,
+normalization, signing and verification, token exchange, and the full
+OAuthTool / OAuth2Tool path through CherryPy's request handling (run
+in-process through the WSGI interface, no sockets involved).
+"""
+import base64
+import io
+import wsgiref.util
+
+import cherrypy
+
+import common
+from common import bench
+from memstore import MemoryDataStore
+from pycrust import oauth
+
+URL = 'http://localhost/v1/things'
+
+
+def make_server(cls=oauth.OAuthServer):
+    server = cls(MemoryDataStore())
+    server.add_signature_method(oauth.OAuthSignatureMethod_PLAINTEXT())
+    server.add_signature_method(oauth.OAuthSignatureMethod_HMAC_SHA1())
+    return server
+
+
+def signed_request(method, token=None, http_url=URL, parameters=None):
+    consumer = MemoryDataStore.consumer
+    request = oauth.OAuthRequest.from_consumer_and_token(consumer, token,
+                http_url=http_url, parameters=dict(parameters or {}))
+    request.sign_request(method, consumer, token)
+    return request
+
+
+def bench_library():
+    consumer = MemoryDataStore.consumer
+    token = MemoryDataStore.token
+    hmac_sha1 = oauth.OAuthSignatureMethod_HMAC_SHA1()
+    plaintext = oauth.OAuthSignatureMethod_PLAINTEXT()
+    server = make_server()
+    params = {'page': '2', 'q': 'some words', 'sort': 'name'}
+
+    request = signed_request(hmac_sha1, token, parameters=params)
+    header = request.to_header()
+    query = 'page=2&q=some+words&sort=name'
+    bench('from_request (header + query)',
+          lambda: oauth.OAuthRequest.from_request('GET', URL, headers=header, query_string=query))
+
+    def normalize():
+        # new request each time, since the result is cached per request
+        return oauth.OAuthRequest('GET', URL, dict(request.parameters)).get_normalized_parameters()
+    bench('get_normalized_parameters', normalize)
+
+    for method in (hmac_sha1, plaintext):
+        name = method.get_name()
+        bench('sign {}'.format(name), lambda: signed_request(method, token, parameters=params))
+
+        signed = signed_request(method, token, parameters=params)
+        signature = signed.get_parameter('oauth_signature')
+        def verify():
+            fresh = oauth.OAuthRequest('GET', URL, dict(signed.parameters))
+            return method.check_signature(fresh, consumer, token, signature)
+        bench('check_signature {}'.format(name), verify)
+
+        bench('verify_request {}'.format(name),
+              lambda: server.verify_request(oauth.OAuthRequest('GET', URL, dict(signed.parameters))))
+
+    request_token = signed_request(hmac_sha1)
+    bench('fetch_request_token',
+          lambda: server.fetch_request_token(oauth.OAuthRequest('GET', URL, dict(request_token.parameters))))
+
+    access_token = signed_request(hmac_sha1, MemoryDataStore.request_token)
+    bench('fetch_access_token',
+          lambda: server.fetch_access_token(oauth.OAuthRequest('GET', URL, dict(access_token.parameters))))
+
+    batch = [signed_request(hmac_sha1, token, parameters={'i': str(i)}) for i in range(100)]
+    bench('verify_requests (100 per batch)',
+          lambda: server.verify_requests([oauth.OAuthRequest('GET', URL, dict(r.parameters)) for r in batch]),
+          number=200)
+
+
+class Root(object):
+    @cherrypy.expose
+    def index(self, **kwargs):
+        return 'plain'
+
+    @cherrypy.expose
+    def things(self, **kwargs):
+        request = cherrypy.request
+        request.oauth_server.verify_request(request.oauth_request)
+        return 'signed'
+
+
+def wsgi_get(path, query='', headers=None, method='GET', body=b''):
+    """Sends one request through cherrypy.tree, returns the status."""
+    environ = {
+        'REQUEST_METHOD':   method,
+        'PATH_INFO':        path,
+        'QUERY_STRING':     query,
+        'HTTP_HOST':        'localhost',
+        'wsgi.input':       io.BytesIO(body),
+    }
+    if body:
+        environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        environ['CONTENT_LENGTH'] = str(len(body))
+    for k, v in (headers or {}).items():
+        environ['HTTP_' + k.upper().replace('-', '_')] = v
+    wsgiref.util.setup_testing_defaults(environ)
+
+    status = []
+    response = cherrypy.tree(environ, lambda s, h, e=None: status.append(s))
+    try:
+        for chunk in response:
+            pass
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return status[0]
+
+
+def bench_tools():
+    from pycrust.oauthtool import OAuthTool, OAuth2Tool
+
+    cherrypy.config.update({'environment': 'embedded', 'log.screen': False})
+    config = {
+        'tools.oauth.realm':            'http://localhost/',
+        'tools.oauth.datastore.class':  'memstore.MemoryDataStore',
+    }
+    app = cherrypy.tree.mount(Root(), '', {'/': config})
+    cherrypy.tools.oauth = OAuthTool()
+    cherrypy.tools.oauth2 = OAuth2Tool()
+    app.config['/'].update({'tools.oauth.on': True, 'tools.oauth2.on': True})
+
+    hmac_sha1 = oauth.OAuthSignatureMethod_HMAC_SHA1()
+    signed = signed_request(hmac_sha1, MemoryDataStore.token, http_url='http://localhost/things')
+    request_token = signed_request(hmac_sha1, http_url='http://localhost/oauth1/request_token')
+    access_token = signed_request(hmac_sha1, MemoryDataStore.request_token,
+                                  http_url='http://localhost/oauth1/access_token')
+    basic = 'Basic ' + base64.b64encode(b'consumer-key:consumer-secret').decode()
+
+    cases = [
+        ('plain request',           lambda: wsgi_get('/', 'page=2')),
+        ('OAuth1 signed request',   lambda: wsgi_get('/things', headers=signed.to_header())),
+        ('OAuth1 request_token',    lambda: wsgi_get('/oauth1/request_token', headers=request_token.to_header())),
+        ('OAuth1 access_token',     lambda: wsgi_get('/oauth1/access_token', headers=access_token.to_header())),
+        ('OAuth2 client_credentials', lambda: wsgi_get('/oauth2/token', method='POST',
+                                        headers={'Authorization': basic},
+                                        body=b'grant_type=client_credentials')),
+    ]
+    for name, func in cases:
+        status = func()
+        assert status.startswith('200'), '{} returned {}'.format(name, status)
+        bench('tool: {}'.format(name), func, number=2000)
+
+
+def main():
+    bench_library()
+    bench_tools()
+
+
+if __name__ == '__main__':
+    common.run(main)
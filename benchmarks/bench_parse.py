@@ -0,0 +1,64 @@
+"""
+Parameter parsing cost per request, for OAuth parameters in the
+Authorization header, in the query string, and split across both.
+
+'legacy' repeats what OAuthTool.before_handler used to do: copy the
+headers, parse_qs() the query string, then parse it again (and the
+URL's query a third time) inside from_request().
+"""
+from six.moves import urllib
+
+import common
+from common import bench
+from pycrust import oauth
+
+
+def legacy_split_url_string(param_str):
+    parameters = urllib.parse.parse_qs(param_str, keep_blank_values=False)
+    for k, v in parameters.items():
+        parameters[k] = urllib.parse.unquote(v[0])
+    return parameters
+
+
+def legacy_parse(url, headers, query_string):
+    headers = headers.copy()
+    parameters = urllib.parse.parse_qs(query_string)
+    auth_header = headers.get('Authorization')
+    if auth_header and auth_header[:6] == 'OAuth ':
+        parameters.update(oauth.OAuthRequest.split_header(auth_header[6:]))
+    if query_string:
+        parameters.update(legacy_split_url_string(query_string))
+    parameters.update(legacy_split_url_string(urllib.parse.urlparse(url)[4]))
+    return parameters
+
+
+def new_parse(url, headers, query_string):
+    return oauth.OAuthRequest.parse_parameters(
+            authorization=headers.get('Authorization'),
+            query_string=query_string)
+
+
+def main():
+    url = 'https://api.example.com/v1/things'
+    consumer = oauth.OAuthConsumer('consumer-key', 'consumer-secret')
+    token = oauth.OAuthToken('token-key', 'token-secret')
+    request = oauth.OAuthRequest.from_consumer_and_token(consumer, token,
+                http_url=url, parameters={'page': '2', 'q': 'some words'})
+    request.sign_request(oauth.OAuthSignatureMethod_HMAC_SHA1(), consumer, token)
+
+    base_headers = {'Host': 'api.example.com', 'Accept': 'application/json',
+                    'User-Agent': 'bench/1.0', 'Accept-Encoding': 'gzip'}
+    header_only = dict(base_headers, **request.to_header())
+    cases = [
+        ('header-only', header_only, ''),
+        ('query-only', base_headers, request.to_postdata()),
+        ('mixed', header_only, 'page=2&q=some+words'),
+    ]
+
+    for name, headers, query_string in cases:
+        bench('legacy {}'.format(name), lambda: legacy_parse(url, headers, query_string), number=20000)
+        bench('parse_parameters {}'.format(name), lambda: new_parse(url, headers, query_string), number=20000)
+
+
+if __name__ == '__main__':
+    common.run(main)
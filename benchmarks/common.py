@@ -0,0 +1,90 @@
+"""
+Shared helpers for the pycrust benchmarks.
+
+Run any of the bench_*.py scripts from the top of the source tree, or
+all of them with run.py, eg:
+
+    python benchmarks/bench_oauth.py
+    python benchmarks/run.py --json results.json
+
+With --json, the results are also written to the given file so that
+two runs can be compared.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+# make the source tree importable without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# every bench() result from this run
+results = []
+
+
+def allocations(func, number=100):
+    """Returns the average number of bytes allocated by one call to func(),
+    as the peak traced memory over a single call.
+    """
+    func()  # warm any caches first
+    tracemalloc.start()
+    try:
+        total = 0
+        for i in range(number):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total / number
+
+
+def bench(name, func, number=10000, repeat=3, trace=True):
+    """Times func() and prints the best of 'repeat' runs in ops/sec,
+    and the bytes it allocates per call.
+    """
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    ops = number / best
+    alloc = allocations(func) if trace else None
+
+    print('{:<44} {:>12,.0f} ops/sec {:>10.2f} usec/op {:>10} B/op'.format(
+            name, ops, best / number * 1e6, '-' if alloc is None else '{:,.0f}'.format(alloc)))
+    results.append({
+        'name':             name,
+        'ops_per_sec':      ops,
+        'usec_per_op':      best / number * 1e6,
+        'bytes_per_op':     alloc,
+        'number':           number,
+    })
+    return ops
+
+
+def write_results(path):
+    with open(path, 'w') as f:
+        json.dump({
+            'date':     datetime.datetime.now().isoformat(),
+            'python':   platform.python_version(),
+            'platform': platform.platform(),
+            'results':  results,
+        }, f, indent=2, sort_keys=True)
+
+
+def run(*mains):
+    """Command line entry point: runs the given main functions and
+    optionally writes the results as JSON.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--json', metavar='FILE', help='write results to FILE')
+    args = parser.parse_args()
+
+    for main in mains:
+        main()
+
+    if args.json:
+        write_results(args.json)
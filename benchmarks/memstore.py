@@ -0,0 +1,39 @@
+"""
+An in-memory OAuthDataStore, so the benchmarks run without a database.
+"""
+from pycrust import oauth
+
+
+class MemoryDataStore(oauth.OAuthDataStore):
+    """One consumer and one access token, and every request or access
+    token it hands out is good."""
+
+    consumer = oauth.OAuthConsumer('consumer-key', 'consumer-secret')
+    token = oauth.OAuthToken('token-key', 'token-secret')
+    request_token = oauth.OAuthToken('request-key', 'request-secret')
+
+    def __init__(self, app=''):
+        pass
+
+    def lookup_consumer(self, key):
+        if key == self.consumer.key:
+            return self.consumer
+
+    def lookup_token(self, token_type, token_key):
+        if token_type == 'request' and token_key == self.request_token.key:
+            return self.request_token
+        if token_key == self.token.key:
+            return self.token
+
+    def lookup_nonce(self, oauth_consumer, oauth_token, nonce):
+        # never a replay, so the same request can be verified repeatedly
+        return None
+
+    def fetch_request_token(self, oauth_consumer, oauth_callback=None):
+        return self.request_token
+
+    def fetch_access_token(self, oauth_consumer, oauth_token, oauth_verifier=None):
+        return self.token
+
+    def authorize_request_token(self, oauth_token, user):
+        return oauth_token
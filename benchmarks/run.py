@@ -0,0 +1,15 @@
+"""
+Runs all of the pycrust benchmarks.
+"""
+import common
+import bench_auth
+import bench_db
+import bench_json
+import bench_nonce
+import bench_oauth
+import bench_parse
+
+
+if __name__ == '__main__':
+    common.run(bench_oauth.main, bench_auth.main, bench_parse.main, bench_nonce.main,
+               bench_db.main, bench_json.main)
@@ -16,7 +16,7 @@ See also the following submodules:
 __author__ = 'Michael Stella <pycrust@thismetalsky.org>'
 __version__ = '1.0.0'
 
-import inspect, logging, os, sys
+import logging, os, sys
 import cherrypy
 import codecs
 
@@ -28,31 +28,54 @@ class BaseHandler(object):
         """Logs to the Cherrypy error log but in a much more pretty way,
         with the handler name and line number
         """
-        if not context:
-            context = inspect.getouterframes(inspect.currentframe())[1]
+        if not cherrypy.log.error_log.isEnabledFor(severity):
+            return
+        if context:
+            # a caller-supplied frame record, as from inspect.getouterframes()
+            location = 'HANDLER ({}:{}:{})'.format(
+                            self.__class__.__name__, context[3], context[2])
+        else:
+            location = self._log_location(sys._getframe(1))
         cherrypy.log.error(msg=msg.strip().replace('\n', '; '), severity=severity,
-                           context='HANDLER ({}:{}:{})'.format(
-                                self.__class__.__name__, context[3], context[2]))
+                           context=location)
+
+    def _log_location(self, frame):
+        """Returns the formatted log context for the given caller frame,
+        cached per class and code location.
+        """
+        key = (self.__class__, frame.f_code, frame.f_lineno)
+        try:
+            return _log_locations[key]
+        except KeyError:
+            location = 'HANDLER ({}:{}:{})'.format(
+                            self.__class__.__name__, frame.f_code.co_name, frame.f_lineno)
+            _log_locations[key] = location
+            return location
+
+    def _log_at(self, msg, severity):
+        # called only from the log_* wrappers, so the handler's frame
+        # is always two levels up
+        if cherrypy.log.error_log.isEnabledFor(severity):
+            cherrypy.log.error(msg=msg.strip().replace('\n', '; '), severity=severity,
+                               context=self._log_location(sys._getframe(2)))
 
     def log_debug(self, msg):
-        return self.log(msg, severity=logging.DEBUG,
-                        context=inspect.getouterframes(inspect.currentframe())[1])
+        return self._log_at(msg, logging.DEBUG)
 
     def log_info(self, msg):
-        return self.log(msg, severity=logging.INFO,
-                        context=inspect.getouterframes(inspect.currentframe())[1])
+        return self._log_at(msg, logging.INFO)
 
     def log_warn(self, msg):
-        return self.log(msg, severity=logging.WARN,
-                        context=inspect.getouterframes(inspect.currentframe())[1])
+        return self._log_at(msg, logging.WARN)
 
     def log_error(self, msg):
-        return self.log(msg, severity=logging.ERROR,
-                        context=inspect.getouterframes(inspect.currentframe())[1])
+        return self._log_at(msg, logging.ERROR)
 
     def log_fatal(self, msg):
-        return self.log(msg, severity=logging.FATAL,
-                        context=inspect.getouterframes(inspect.currentframe())[1])
+        return self._log_at(msg, logging.FATAL)
+
+# (class, code object, line number) -> formatted log context
+_log_locations = {}
 
 
 def url(*args, **kwargs):
@@ -4,45 +4,565 @@ User authentication and authorization for CherryPy
 This code is based on the examples and discussion at
 http://tools.cherrypy.org/wiki/AuthenticationAndAccessRestrictions
 
+Conditions which need more than the user id can get the user object
+(the "principal") from get_principal().  It's loaded at most once per
+request, and only if something asks for it, by the function configured
+as:
+
+    auth.principal.loader = 'myapp.model.load_user'   # uid -> user
+    auth.principal.ttl    = 60      # optional cache across requests
+    auth.principal.size   = 1024
+
+auth_has_role() expects the principal to have a 'roles' collection.
+
+Signed tokens
+-------------
+
+Instead of keeping the user id in the CherryPy session, check_auth can
+take it from an HMAC-signed token carrying the uid and an expiry time,
+sent either as a cookie or as an "Authorization: Bearer" header.  This
+needs no session storage at all:
+
+    auth.mode           = 'token'
+    auth.token.keys     = {'2': 'new secret', '1': 'old secret'}
+    auth.token.key_id   = '2'           # the key new tokens are signed with
+    auth.token.cookie   = 'auth_token'
+    auth.token.ttl      = 3600
+
+Tokens signed with any of the listed keys are accepted, so keys can be
+rotated by adding a new one, switching key_id to it, and dropping the
+old one once its tokens have expired.  Log users in with
+set_token_cookie(uid), or hand make_token(uid) to API clients.
+
+Unauthenticated requests
+------------------------
+
+By default a request without a user gets a 401 if its Accept header
+asks for JSON, and is redirected to the login page otherwise.  This
+can be set for any part of an app:
+
+    auth.unauthenticated = 'status'     # always 401, eg. for an API
+    auth.unauthenticated = 'redirect'   # always the login page
 
 """
 
 __author__ = 'Michael Stella <pycrust@thismetalsky.org>'
 
+import base64
+import collections
+import hashlib
+import hmac
+import inspect
+import json
+import time
+import types
+import weakref
+
 import cherrypy
 from six.moves import urllib
 
-from pycrust import url
+from pycrust import load_class, url
+from pycrust.cache import LRUCache
+
+def _unauthenticated(config):
+    """How to answer an unauthenticated request: 'status' for a 401,
+    'redirect' to the login page, or 'negotiate' on the Accept header
+    """
+    return config.get('auth.unauthenticated') or 'negotiate'
 
 def check_auth(*args, **kwargs):
     """Check authentication before each handler"""
 
-    conditions = cherrypy.request.config.get('auth.require', None)
+    request = cherrypy.serving.request
+    conditions = request.config.get('auth.require', None)
     if conditions:
-        uid = cherrypy.session.get('uid')
+        requirement = find_requirement(conditions)
+        if request.config.get('auth.mode', 'session') == 'token':
+            uid = token_uid()
+        else:
+            uid = cherrypy.session.get('uid')
         if uid:
-            cherrypy.request.login = uid
-            for c in conditions:
-                if not c():
-                    raise cherrypy.HTTPError(403)
+            request.login = uid
+            if not requirement.plan():
+                raise cherrypy.HTTPError(403)
 
         else:
             # throw a 401 rather than redirect if this is a JSON-wanting request
             # not sure why some things set HTTP_ACCEPT and others ACCEPT
-            for h in ('ACCEPT', 'HTTP_ACCEPT'):
-                if (h in cherrypy.request.headers and
-                    'application/json' in cherrypy.request.headers[h]):
+            unauthenticated = _unauthenticated(request.config)
+            if unauthenticated == 'status':
+                raise cherrypy.HTTPError(401)
+            if unauthenticated == 'negotiate':
+                accept = request.headers.get('Accept') or request.headers.get('HTTP_ACCEPT') or ''
+                if 'application/json' in accept:
                     raise cherrypy.HTTPError(401)
 
             # otherwise, for a normal request,
             # redirect to the login page, preserving the 'return' URL
+            if request.config.get('auth.login.cache', False):
+                raise cherrypy.HTTPRedirect(cached_login_redirect(request))
             target = url('login')
-            referer = cherrypy.request.request_line.split()[1]
+            referer = request.request_line.split()[1]
             if referer:
                 target = "%s?ret=%s" % (target,  urllib.parse.quote(referer))
             raise cherrypy.HTTPRedirect(target)
 
-cherrypy.tools.auth = cherrypy.Tool('before_handler', check_auth)
+
+## login redirects
+#
+# With auth.login.cache on, the login page URL is worked out once per app
+# (or taken from auth.login.url), and the redirect target for each path
+# is kept in a small LRU cache, so a flood of unauthenticated requests
+# costs little more than a dict lookup each.
+
+# script name -> login URL
+_login_urls = {}
+
+# script name -> LRUCache of (path, query string) -> redirect target
+_login_redirects = {}
+
+def login_url(request):
+    """The login page URL for the request's app"""
+    try:
+        return _login_urls[request.script_name]
+    except KeyError:
+        target = _login_urls[request.script_name] = \
+                    request.config.get('auth.login.url') or url('login')
+        return target
+
+def cached_login_redirect(request):
+    """Returns the login redirect target for the request, with the
+    request's path and query string as the 'ret' parameter.
+    """
+    try:
+        cache = _login_redirects[request.script_name]
+    except KeyError:
+        cache = _login_redirects.setdefault(request.script_name,
+                    LRUCache(request.config.get('auth.login.cache_size', 1024), ttl=3600))
+
+    key = (request.path_info, request.query_string)
+    target = cache.get(key)
+    if target is LRUCache.MISSING:
+        referer = request.script_name + request.path_info
+        if request.query_string:
+            referer += '?' + request.query_string
+        target = "%s?ret=%s" % (login_url(request), urllib.parse.quote(referer))
+        cache.put(key, target)
+    return target
+
+
+class AuthTool(cherrypy.Tool):
+    """The auth tool, which only hooks itself into requests
+    which have an auth.require
+    """
+    def _setup(self):
+        if cherrypy.serving.request.config.get('auth.require'):
+            cherrypy.Tool._setup(self)
+
+cherrypy.tools.auth = AuthTool('before_handler', check_auth)
+
+
+## signed tokens
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def _token_signature(key, signed):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return _b64encode(hmac.new(key, signed.encode('ascii'), hashlib.sha256).digest())
+
+def make_token(uid, ttl=None, key_id=None, keys=None):
+    """Returns a signed token for the given user id, good for 'ttl'
+    seconds.  Anything not given is taken from the auth.token config.
+    """
+    config = cherrypy.request.config
+    if ttl is None:
+        ttl = config.get('auth.token.ttl', 3600)
+    if keys is None:
+        keys = config['auth.token.keys']
+    if key_id is None:
+        key_id = config['auth.token.key_id']
+
+    payload = _b64encode(json.dumps([uid, int(time.time() + ttl)],
+                                    separators=(',', ':')).encode('utf-8'))
+    signed = '{}.{}'.format(key_id, payload)
+    return '{}.{}'.format(signed, _token_signature(keys[key_id], signed))
+
+def verify_token(token, keys):
+    """Returns the user id from a token if it was signed by one of
+    'keys' (a dict of key id -> secret) and hasn't expired, else None.
+    """
+    try:
+        # tokens are ASCII, and compare_digest() refuses anything else
+        token.encode('ascii')
+        key_id, payload, signature = token.split('.')
+        key = keys[key_id]
+    except (AttributeError, ValueError, KeyError):
+        return None
+
+    expected = _token_signature(key, '{}.{}'.format(key_id, payload))
+    if not hmac.compare_digest(expected, signature):
+        return None
+
+    try:
+        uid, expires = json.loads(_b64decode(payload).decode('utf-8'))
+    except ValueError:
+        return None
+    if expires < time.time():
+        return None
+    return uid
+
+def token_uid():
+    """Returns the user id from the current request's bearer token
+    or token cookie, if it's valid.
+    """
+    request = cherrypy.request
+    token = None
+    authorization = request.headers.get('Authorization', '')
+    if authorization[:7] == 'Bearer ':
+        token = authorization[7:].strip()
+    else:
+        cookie = request.cookie.get(request.config.get('auth.token.cookie', 'auth_token'))
+        if cookie is not None:
+            token = cookie.value
+    if not token:
+        return None
+    return verify_token(token, request.config.get('auth.token.keys', {}))
+
+def set_token_cookie(uid, ttl=None):
+    """Logs a user in by sending them a token cookie"""
+    config = cherrypy.request.config
+    if ttl is None:
+        ttl = config.get('auth.token.ttl', 3600)
+    name = config.get('auth.token.cookie', 'auth_token')
+    cookie = cherrypy.response.cookie
+    cookie[name] = make_token(uid, ttl)
+    cookie[name]['path'] = '/'
+    cookie[name]['max-age'] = int(ttl)
+    cookie[name]['httponly'] = True
+    if cherrypy.request.scheme == 'https':
+        cookie[name]['secure'] = True
+
+def clear_token_cookie():
+    """Logs a user out by expiring their token cookie"""
+    name = cherrypy.request.config.get('auth.token.cookie', 'auth_token')
+    cookie = cherrypy.response.cookie
+    cookie[name] = ''
+    cookie[name]['path'] = '/'
+    cookie[name]['max-age'] = 0
+
+
+## principals
+
+# dotted name -> loader function
+_loaders = {}
+
+# loader function -> LRUCache of uid -> principal, when auth.principal.ttl is set
+_principal_caches = {}
+
+def _principal_loader(config):
+    loader = config.get('auth.principal.loader')
+    if loader is None or callable(loader):
+        return loader
+    try:
+        return _loaders[loader]
+    except KeyError:
+        func = _loaders[loader] = load_class(loader)
+        return func
+
+def get_principal():
+    """Returns the user object for the logged-in user, loading it
+    the first time it's needed in a request.  None if nobody is
+    logged in, or no auth.principal.loader is configured.
+    """
+    request = cherrypy.serving.request
+    try:
+        return request.principal
+    except AttributeError:
+        pass
+
+    principal = None
+    uid = getattr(request, 'login', None)
+    loader = _principal_loader(request.config)
+    if uid and loader:
+        ttl = request.config.get('auth.principal.ttl')
+        if ttl:
+            try:
+                cache = _principal_caches[loader]
+            except KeyError:
+                cache = _principal_caches.setdefault(loader,
+                            LRUCache(request.config.get('auth.principal.size', 1024), ttl))
+            principal = cache.get(uid)
+            if principal is LRUCache.MISSING:
+                principal = loader(uid)
+                cache.put(uid, principal)
+        else:
+            principal = loader(uid)
+
+    request.principal = principal
+    return principal
+
+def invalidate_principal(uid=None):
+    """Drops a cached principal (or all of them), eg. after
+    changing a user's roles.
+    """
+    for cache in _principal_caches.values():
+        if uid is None:
+            cache.clear()
+        else:
+            cache.pop(uid)
+
+
+## compiled conditions
+#
+# Conditions are combined into a tree of Condition, AllOf and OneOf
+# objects.  Nested combinators of the same kind are flattened and repeated
+# conditions dropped when the tree is built, and each condition is
+# evaluated at most once per request, however many trees it appears in.
+
+# tuple of conditions -> compiled plan, for the most recently used lists
+_plans = LRUCache(size=1024, ttl=float('inf'))
+
+
+class _MemoKey(object):
+    """Identifies a condition's result in the per-request memo; cheaper
+    to hash than the condition's key.
+    """
+    __slots__ = ('__weakref__',)
+
+# condition key -> _MemoKey, shared by the conditions with that key
+# for as long as any of them is alive
+_memo_keys = weakref.WeakValueDictionary()
+
+def _memo_key(key):
+    memo_key = _memo_keys.get(key)
+    if memo_key is None:
+        memo_key = _memo_keys.setdefault(key, _MemoKey())
+    return memo_key
+
+def compile_conditions(conditions):
+    """Returns the compiled AllOf plan for a list of conditions,
+    building it only the first time.
+    """
+    key = tuple(conditions)
+    plan = _plans.get(key)
+    if plan is LRUCache.MISSING:
+        plan = AllOf(*conditions)
+        _plans.put(key, plan)
+    return plan
+
+def _request_memo():
+    """The leaf condition results for the current request"""
+    request = cherrypy.serving.request
+    try:
+        return request.auth_results
+    except AttributeError:
+        request.auth_results = {}
+        return request.auth_results
+
+def as_condition(c):
+    """Wraps a plain callable as a Condition"""
+    if isinstance(c, (Condition, AllOf, OneOf)):
+        return c
+    return Condition(c)
+
+def _flatten(cls, conditions):
+    """Merges nested cls conditions into one list, without repeats"""
+    flat = []
+    seen = set()
+    for c in conditions:
+        c = as_condition(c)
+        for child in (c.conditions if isinstance(c, cls) else (c,)):
+            if child.key not in seen:
+                seen.add(child.key)
+                flat.append(child)
+    return tuple(flat)
+
+
+class Condition(object):
+    """A single condition.  'key' identifies conditions which are the
+    same, it defaults to the function itself.
+    """
+    def __init__(self, func, key=None):
+        self.func = func
+        self.key = func if key is None else key
+        self.id = _memo_key(self.key)
+
+    def evaluate(self, memo):
+        try:
+            return memo[self.id]
+        except KeyError:
+            result = memo[self.id] = bool(self.func())
+            return result
+
+    def __call__(self):
+        return self.evaluate(_request_memo())
+
+
+class AllOf(object):
+    """True if all of the conditions are, checked in order"""
+    def __init__(self, *conditions):
+        self.conditions = _flatten(AllOf, conditions)
+        self.key = ('all_of',) + tuple(c.key for c in self.conditions)
+        self.id = _memo_key(self.key)
+
+    def evaluate(self, memo):
+        try:
+            return memo[self.id]
+        except KeyError:
+            pass
+        result = True
+        for c in self.conditions:
+            if not c.evaluate(memo):
+                result = False
+                break
+        memo[self.id] = result
+        return result
+
+    def __call__(self):
+        return self.evaluate(_request_memo())
+
+
+class OneOf(object):
+    """True if any of the conditions are, checked in order"""
+    def __init__(self, *conditions):
+        self.conditions = _flatten(OneOf, conditions)
+        self.key = ('one_of',) + tuple(c.key for c in self.conditions)
+        self.id = _memo_key(self.key)
+
+    def evaluate(self, memo):
+        try:
+            return memo[self.id]
+        except KeyError:
+            pass
+        result = False
+        for c in self.conditions:
+            if c.evaluate(memo):
+                result = True
+                break
+        memo[self.id] = result
+        return result
+
+    def __call__(self):
+        return self.evaluate(_request_memo())
+
+
+## requirement index
+#
+# Built when the engine starts from every auth.require found in the app
+# configs and on the exposed handlers, so that a request only needs one
+# dict lookup to find the compiled plan for its requirement list.  Lists
+# which only turn up later (eg. with the routes dispatcher) are added the
+# first time they're seen.
+
+AuthRequirement = collections.namedtuple('AuthRequirement',
+                        'conditions plan locations')
+
+# id(auth.require list) -> AuthRequirement
+_requirements = {}
+
+def add_requirement(conditions, location):
+    """Compiles an auth.require list into the index"""
+    try:
+        requirement = _requirements[id(conditions)]
+        if requirement.conditions is conditions:
+            if location not in requirement.locations:
+                requirement.locations.append(location)
+            return requirement
+    except KeyError:
+        pass
+
+    requirement = AuthRequirement(conditions, compile_conditions(conditions),
+                                  [location])
+    _requirements[id(conditions)] = requirement
+    return requirement
+
+def find_requirement(conditions):
+    """Returns the indexed AuthRequirement for an auth.require list"""
+    requirement = _requirements.get(id(conditions))
+    if requirement is not None and requirement.conditions is conditions:
+        return requirement
+    return add_requirement(conditions, cherrypy.serving.request.path_info)
+
+def _attributes(obj):
+    """Yields (name, value) for obj's public attributes, looked up
+    statically so that properties and other descriptors aren't run
+    """
+    for name in dir(obj):
+        if name.startswith('_'):
+            continue
+        try:
+            value = inspect.getattr_static(obj, name)
+        except AttributeError:
+            continue
+        if isinstance(value, (staticmethod, classmethod)):
+            value = value.__func__
+        yield name, value
+
+def _is_exposed(obj):
+    """True for an exposed handler, without running any __getattr__"""
+    if isinstance(obj, types.FunctionType):
+        return getattr(obj, 'exposed', False)
+    if isinstance(obj, (types.ModuleType, type)) or not hasattr(obj, '__dict__'):
+        return False
+    return bool(vars(obj).get('exposed') or getattr(type(obj), 'exposed', False))
+
+def _is_parent(obj, depth=2):
+    """True if obj looks like part of the handler tree: an object (not a
+    module or class) with exposed handlers, or with objects under it
+    which have them, looking at most 'depth' levels down
+    """
+    if callable(obj) or isinstance(obj, (types.ModuleType, type)) or \
+            not hasattr(obj, '__dict__'):
+        return False
+    for name, child in _attributes(obj):
+        if _is_exposed(child) or (depth and _is_parent(child, depth - 1)):
+            return True
+    return False
+
+def _walk_handlers(obj, path, seen):
+    """Yields (path, handler) for the exposed handlers under obj,
+    only descending into objects which hold some
+    """
+    if _is_exposed(obj):
+        yield path or '/', obj
+    if callable(obj) or id(obj) in seen:
+        return
+    seen[id(obj)] = obj
+
+    for name, child in _attributes(obj):
+        if _is_exposed(child) or _is_parent(child):
+            for found in _walk_handlers(child, path + '/' + name, seen):
+                yield found
+
+def build_requirement_index():
+    """Indexes every auth.require in the mounted apps"""
+    for script_name, app in cherrypy.tree.apps.items():
+        for section, config in app.config.items():
+            if config.get('auth.require'):
+                add_requirement(config['auth.require'], script_name + section)
+
+        root = getattr(app, 'root', None)
+        if root is None:
+            continue
+        for path, handler in _walk_handlers(root, '', {}):
+            config = getattr(handler, '_cp_config', None) or {}
+            if config.get('auth.require'):
+                add_requirement(config['auth.require'], script_name + path)
+
+cherrypy.engine.subscribe('start', build_requirement_index)
+
+def list_requirement_index():
+    """Returns the requirement index as a list of dicts, for debugging"""
+    return [{
+                'locations':        list(r.locations),
+                'conditions':       len(r.conditions),
+                'plan':             len(r.plan.conditions),
+            } for r in _requirements.values()]
 
 
 ## auth decorators
@@ -53,24 +573,15 @@ def require(*conditions):
         if 'auth.require' not in f._cp_config:
             f._cp_config['auth.require'] = []
         f._cp_config['auth.require'].extend(conditions)
+        compile_conditions(f._cp_config['auth.require'])
         return f
     return decorate
 
 def all_of(*conditions):
-    def check():
-        for c in conditions:
-            if not c():
-                return False
-        return True
-    return check
+    return AllOf(*conditions)
 
 def one_of(*conditions):
-    def check():
-        for c in conditions:
-            if c():
-                return True
-        return False
-    return check
+    return OneOf(*conditions)
 
 ## auth conditions
 def auth_valid_user():
@@ -79,9 +590,15 @@ def auth_valid_user():
         if cherrypy.request.login:
             return True
         return False
-    return check
+    return Condition(check, key=('auth_valid_user',))
 
 def auth_user(id):
     """True if the userid matches"""
-    return lambda: cherrypy.request.login == id
+    return Condition(lambda: cherrypy.request.login == id, key=('auth_user', id))
 
+def auth_has_role(role):
+    """True if the logged-in user has the given role"""
+    def check():
+        principal = get_principal()
+        return principal is not None and role in getattr(principal, 'roles', ())
+    return Condition(check, key=('auth_has_role', role))
@@ -0,0 +1,59 @@
+"""
+Small caching helpers shared by the pycrust modules.
+
+"""
+
+__author__ = 'Michael Stella <pycrust@thismetalsky.org>'
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe LRU cache whose entries expire after 'ttl' seconds."""
+    MISSING = object()
+
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or MISSING."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return self.MISSING
+            if expires < time.time():
+                del self._data[key]
+                self.misses += 1
+                return self.MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -33,12 +33,24 @@ import base64
 import hashlib
 import hmac
 import json
+import mmap
+import os
 import random
 import six
+import struct
+import threading
 import time
 import uuid
+from concurrent import futures
 from six.moves import urllib
 
+from pycrust.cache import LRUCache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # no SharedNonceStore on this platform
+
 
 VERSION = '1.0' # Hi Blaine!
 OAUTH2_VERSION = '2.0'
@@ -207,6 +219,11 @@ class OAuthRequestBase():
     http_url    = None
     version     = VERSION
 
+    # cached signing material, see get_signature_base_string()
+    _normalized_parameters = None
+    _base_string = None
+    _base_string_for = None
+
     def __init__(self, http_method=HTTP_METHOD, http_url=None, parameters=None):
         self.http_method = http_method
         self.http_url = http_url
@@ -214,6 +231,7 @@ class OAuthRequestBase():
 
     def set_parameter(self, parameter, value):
         self.parameters[parameter] = value
+        self._normalized_parameters = None
 
     def get_parameter(self, parameter):
         try:
@@ -254,20 +272,39 @@ class OAuthRequestBase():
         return '%s?%s' % (self.get_normalized_http_url(), self.to_postdata())
 
     def get_normalized_parameters(self):
-        """Return a string that contains the parameters that must be signed."""
-        params = self.parameters
+        """Return a string that contains the parameters that must be signed.
 
-        # Exclude the signature if it exists.
-        if 'oauth_signature' in params:
-            del params['oauth_signature']
+        The result is cached until the next call to set_parameter(), so
+        code which modifies self.parameters directly must go through it.
+        """
+        if self._normalized_parameters is not None:
+            return self._normalized_parameters
 
-        # Escape key values before sorting.
+        # Escape key values before sorting, excluding the signature if it
+        # exists (without removing it, so the request can be checked again).
         # NOTE: this approach is broken on Python <3 if your input has unicode characters!
-        key_values = [(escape(_utf8_str(k)), escape(_utf8_str(v))) for k,v in list(params.items())]
+        key_values = [(escape(_utf8_str(k)), escape(_utf8_str(v)))
+                        for k,v in self.parameters.items() if k != 'oauth_signature']
         # Sort lexicographically, first after key, then after value.
         key_values.sort()
         # Combine key value pairs into a string.
-        return '&'.join(['%s=%s' % (k, v) for k, v in key_values])
+        self._normalized_parameters = '&'.join(['%s=%s' % (k, v) for k, v in key_values])
+        return self._normalized_parameters
+
+    def get_signature_base_string(self):
+        """Return the escaped method&url&parameters string that gets signed,
+        computing it only once per request.
+        """
+        normalized = self.get_normalized_parameters()
+        source = (self.http_method, self.http_url, normalized)
+        if self._base_string_for != source:
+            self._base_string = '&'.join((
+                escape(self.get_normalized_http_method()),
+                escape(self.get_normalized_http_url()),
+                escape(normalized),
+            ))
+            self._base_string_for = source
+        return self._base_string
 
     def get_normalized_http_method(self):
         """Uppercases the http method."""
@@ -298,46 +335,54 @@ class OAuthRequestBase():
     @classmethod
     def from_request(cls, http_method, http_url, headers=None, parameters=None, query_string=None):
         """Combines multiple parameter sources."""
+        parameters = cls.parse_parameters(
+                authorization=headers.get('Authorization') if headers else None,
+                query_string=query_string,
+                parameters=parameters)
+
+        # URL parameters.
+        if http_url and '?' in http_url:
+            param_str = urllib.parse.urlparse(http_url)[4] # query
+            parameters.update(cls.split_url_string(param_str))
+
+        if parameters:
+            return cls(http_method, http_url, parameters)
+
+        return None
+
+    @classmethod
+    def parse_parameters(cls, authorization=None, query_string=None, parameters=None):
+        """Collects the request parameters in one pass over each source:
+        'parameters' (normally the form body), then the Authorization
+        header, then the query string, with later sources taking
+        precedence.  Returns the 'parameters' dict, updated.
+        """
         if parameters is None:
             parameters = {}
 
-        # Headers
-        if headers and 'Authorization' in headers:
-            auth_header = headers['Authorization']
+        if authorization:
             # Check that the authorization header is OAuth.
-            if auth_header[:6] == 'OAuth ':
-                auth_header = auth_header[6:]
+            if authorization[:6] == 'OAuth ':
                 try:
                     # Get the parameters from the header.
-                    header_params = cls.split_header(auth_header)
-                    parameters.update(header_params)
+                    parameters.update(cls.split_header(authorization[6:]))
                 except:
                     raise OAuthError('Unable to parse OAuth parameters from Authorization header.')
 
             # handle Basic auth, for grant_type=client_credentials
-            elif auth_header[:6] == 'Basic ':
-                auth_header = auth_header[6:] + '=='
+            elif authorization[:6] == 'Basic ':
                 try:
-                    key,secret = base64.b64decode(auth_header.encode('utf-8')).decode().split(':')
-                    parameters.update({'client_id': key, 'client_secret': secret})
+                    key,secret = base64.b64decode((authorization[6:] + '==').encode('utf-8')).decode().split(':')
+                    parameters['client_id'] = key
+                    parameters['client_secret'] = secret
                 except:
                     raise OAuthError('Unable to parse OAuth parameters from Authorization header.')
 
-
         # GET or POST query string.
         if query_string:
-            query_params = cls.split_url_string(query_string)
-            parameters.update(query_params)
-
-        # URL parameters.
-        param_str = urllib.parse.urlparse(http_url)[4] # query
-        url_params = cls.split_url_string(param_str)
-        parameters.update(url_params)
-
-        if parameters:
-            return cls(http_method, http_url, parameters)
+            parameters.update(cls.split_url_string(query_string))
 
-        return None
+        return parameters
 
     @classmethod
     def from_consumer_and_token(cls, oauth_consumer, token=None,
@@ -394,17 +439,34 @@ class OAuthRequestBase():
             # Remove whitespace.
             param = param.strip()
             # Split key-value.
-            param_parts = param.split('=', 1)
+            key, sep, value = param.partition('=')
+            if not sep:
+                raise ValueError('Malformed Authorization parameter: %s' % param)
             # Remove quotes and unescape the value.
-            params[param_parts[0]] = urllib.parse.unquote(param_parts[1].strip('\"'))
+            value = value.strip('\"')
+            if '%' in value:
+                value = urllib.parse.unquote(value)
+            params[key] = value
         return params
 
     @staticmethod
     def split_url_string(param_str):
-        """Turn URL string into parameters."""
-        parameters = urllib.parse.parse_qs(param_str, keep_blank_values=False)
-        for k, v in parameters.items():
-            parameters[k] = urllib.parse.unquote(v[0])
+        """Turn URL string into parameters.  Blank values are dropped,
+        and the first of any repeated parameter wins.
+        """
+        parameters = {}
+        unquote = urllib.parse.unquote_plus
+        for pair in param_str.split('&'):
+            key, sep, value = pair.partition('=')
+            if not value:
+                continue
+            if '%' in key or '+' in key:
+                key = unquote(key)
+            if key in parameters:
+                continue
+            if '%' in value or '+' in value:
+                value = unquote(value)
+            parameters[key] = value
         return parameters
 
 
@@ -420,6 +482,8 @@ class OAuthServer():
     version = VERSION
     signature_methods = None
     data_store = None
+    consumer_key_parameter = 'oauth_consumer_key'
+    token_key_parameter = 'oauth_token'
 
     def __init__(self, data_store=None, signature_methods=None):
         self.data_store = data_store
@@ -487,6 +551,87 @@ class OAuthServer():
         parameters = oauth_request.get_nonoauth_parameters()
         return consumer, token, parameters
 
+    def verify_requests(self, oauth_requests, max_workers=None):
+        """Verifies many api calls at once, eg. for a batch endpoint.
+
+        Consumers and tokens are looked up once per distinct key, and the
+        nonces of every request with a good signature are checked in one
+        call to the data store's lookup_nonces().  If max_workers is given,
+        signatures are checked on a pool of that many threads.
+
+        Returns a list of (consumer, token, parameters, error) in the same
+        order as the requests, where error is None, or the OAuthError that
+        request failed with.
+        """
+        oauth_requests = list(oauth_requests)
+        results = [None] * len(oauth_requests)
+        consumers = {}
+        tokens = {}
+        checks = []
+
+        for i, oauth_request in enumerate(oauth_requests):
+            try:
+                self._get_version(oauth_request)
+                consumer_key = oauth_request.get_parameter(self.consumer_key_parameter)
+                if consumer_key not in consumers:
+                    consumers[consumer_key] = self.data_store.lookup_consumer(consumer_key)
+                consumer = consumers[consumer_key]
+                if not consumer:
+                    raise OAuthError('Invalid consumer.')
+
+                token_key = oauth_request.get_parameter(self.token_key_parameter)
+                if token_key not in tokens:
+                    tokens[token_key] = self.data_store.lookup_token('access', token_key)
+                token = tokens[token_key]
+                if not token:
+                    raise OAuthError('Invalid access token: %s' % token_key)
+
+                timestamp, nonce = oauth_request._get_timestamp_nonce()
+                self._check_timestamp(timestamp)
+                signature_method = self._get_signature_method(oauth_request)
+                try:
+                    signature = oauth_request.get_parameter('oauth_signature')
+                except:
+                    raise OAuthError('Missing signature.')
+            except ValueError as e:
+                results[i] = (None, None, None, OAuthError('Invalid request: %s' % e))
+                continue
+            except OAuthError as e:
+                results[i] = (None, None, None, e)
+                continue
+            checks.append((i, oauth_request, consumer, token, nonce, signature_method, signature,
+                           timestamp))
+
+        def check(item):
+            i, oauth_request, consumer, token, nonce, signature_method, signature = item[:7]
+            return signature_method.check_signature(oauth_request, consumer, token, signature)
+
+        if max_workers and len(checks) > 1:
+            with futures.ThreadPoolExecutor(max_workers) as pool:
+                valid = list(pool.map(check, checks))
+        else:
+            valid = [check(item) for item in checks]
+
+        passed = []
+        for item, valid_sig in zip(checks, valid):
+            i, oauth_request, consumer, token, nonce, signature_method, signature = item[:7]
+            if valid_sig:
+                passed.append(item)
+            else:
+                key, base = signature_method.build_signature_base_string(oauth_request, consumer, token)
+                results[i] = (None, None, None,
+                    OAuthError('Invalid signature. Expected signature base string: %s' % base))
+
+        seen = self._lookup_nonces([(item[2], item[3], item[4], item[7]) for item in passed])
+        for item, used in zip(passed, seen):
+            i, oauth_request, consumer, token, nonce = item[:5]
+            if used:
+                results[i] = (None, None, None, OAuthError('Nonce already used: %s' % str(used)))
+            else:
+                results[i] = (consumer, token, oauth_request.get_nonoauth_parameters(), None)
+
+        return results
+
     def authorize_token(self, token, user):
         """Authorize a request token."""
         return self.data_store.authorize_request_token(token, user)
@@ -526,7 +671,7 @@ class OAuthServer():
         return signature_method
 
     def _get_consumer(self, oauth_request):
-        consumer_key = oauth_request.get_parameter('oauth_consumer_key')
+        consumer_key = oauth_request.get_parameter(self.consumer_key_parameter)
         consumer = self.data_store.lookup_consumer(consumer_key)
         if not consumer:
             raise OAuthError('Invalid consumer.')
@@ -534,7 +679,7 @@ class OAuthServer():
 
     def _get_token(self, oauth_request, token_type='access'):
         """Try to find the token for the provided request token key."""
-        token_field = oauth_request.get_parameter('oauth_token')
+        token_field = oauth_request.get_parameter(self.token_key_parameter)
         token = self.data_store.lookup_token(token_type, token_field)
         if not token:
             raise OAuthError('Invalid %s token: %s' % (token_type, token_field))
@@ -546,7 +691,7 @@ class OAuthServer():
     def _check_signature(self, oauth_request, consumer, token):
         timestamp, nonce = oauth_request._get_timestamp_nonce()
         self._check_timestamp(timestamp)
-        self._check_nonce(consumer, token, nonce)
+        self._check_nonce(consumer, token, nonce, timestamp)
         signature_method = self._get_signature_method(oauth_request)
         try:
             signature = oauth_request.get_parameter('oauth_signature')
@@ -557,7 +702,6 @@ class OAuthServer():
         if not valid_sig:
             key, base = signature_method.build_signature_base_string(oauth_request, consumer, token)
             raise OAuthError('Invalid signature. Expected signature base string: %s' % base)
-        built = signature_method.build_signature(oauth_request, consumer, token)
 
     def _check_timestamp(self, timestamp):
         """Verify that timestamp is recentish."""
@@ -568,29 +712,41 @@ class OAuthServer():
             raise OAuthError('Expired timestamp: given %d and now %s has a '
                 'greater difference than threshold %d' %
                 (timestamp, now, self.timestamp_threshold))
+        # a request from the future would stay valid for longer than
+        # its nonce is remembered
+        if -lapsed > self.timestamp_threshold:
+            raise OAuthError('Invalid timestamp: given %d is ahead of now %s '
+                'by more than threshold %d' %
+                (timestamp, now, self.timestamp_threshold))
 
-    def _check_nonce(self, consumer, token, nonce):
+    def _check_nonce(self, consumer, token, nonce, timestamp=None):
         """Verify that the nonce is uniqueish."""
-        nonce = self.data_store.lookup_nonce(consumer, token, nonce)
+        if timestamp is not None and getattr(self.data_store, 'nonce_timestamps', False):
+            nonce = self.data_store.lookup_nonce(consumer, token, nonce, int(timestamp))
+        else:
+            nonce = self.data_store.lookup_nonce(consumer, token, nonce)
         if nonce:
             raise OAuthError('Nonce already used: %s' % str(nonce))
 
-class OAuth2Server(OAuthServer):
-
-    def _get_consumer(self, oauth_request):
-        consumer_key = oauth_request.get_parameter('client_id')
-        consumer = self.data_store.lookup_consumer(consumer_key)
-        if not consumer:
-            raise OAuthError('Invalid consumer.')
-        return consumer
+    def _lookup_nonces(self, nonces):
+        """Checks a list of (consumer, token, nonce, timestamp) in one go,
+        if the data store can, returning the lookup_nonce() result for each.
+        The timestamp is only passed on to data stores with nonce_timestamps.
+        """
+        if not nonces:
+            return []
+        if not getattr(self.data_store, 'nonce_timestamps', False):
+            nonces = [n[:3] for n in nonces]
+        else:
+            nonces = [n[:3] + (int(n[3]),) for n in nonces]
+        lookup_nonces = getattr(self.data_store, 'lookup_nonces', None)
+        if lookup_nonces is not None:
+            return lookup_nonces(nonces)
+        return [self.data_store.lookup_nonce(*n) for n in nonces]
 
-    def _get_token(self, oauth_request, token_type='access'):
-        """Try to find the token for the provided request token key."""
-        token_field = oauth_request.get_parameter('code')
-        token = self.data_store.lookup_token(token_type, token_field)
-        if not token:
-            raise OAuthError('Invalid %s token: %s' % (token_type, token_field))
-        return token
+class OAuth2Server(OAuthServer):
+    consumer_key_parameter = 'client_id'
+    token_key_parameter = 'code'
 
     def _check_signature(self, oauth_request, consumer, token):
         timestamp, nonce = oauth_request._get_timestamp_nonce()
@@ -606,7 +762,6 @@ class OAuth2Server(OAuthServer):
         if not valid_sig:
             key, base = signature_method.build_signature_base_string(oauth_request, consumer, token)
             raise OAuthError('Invalid signature. Expected signature base string: %s' % base)
-        built = signature_method.build_signature(oauth_request, consumer, token)
 
     def fetch_request_token(self, oauth_request):
         """Processes a request_token request and returns the
@@ -701,6 +856,14 @@ class OAuthDataStore():
         """-> OAuthToken."""
         raise NotImplementedError
 
+    def lookup_nonces(self, nonces):
+        """Checks a list of (consumer, token, nonce) tuples,
+        -> list of lookup_nonce() results.
+
+        Override this to check them all in one query.
+        """
+        return [self.lookup_nonce(*n) for n in nonces]
+
     def fetch_request_token(self, oauth_consumer, oauth_callback):
         """-> OAuthToken."""
         raise NotImplementedError
@@ -714,8 +877,331 @@ class OAuthDataStore():
         raise NotImplementedError
 
 
+class CachingDataStore():
+    """Wraps any OAuthDataStore, caching consumer and token lookups.
+
+    Lookups which find nothing are cached as well, for negative_ttl
+    seconds, so that a flood of bad keys doesn't reach the database.
+    Only the token types listed in token_types are cached; request
+    tokens are short-lived and shouldn't outlive their exchange.
+
+    Call invalidate_consumer() / invalidate_token() when revoking
+    anything, everything else is passed through to the wrapped store.
+    """
+
+    def __init__(self, data_store, size=1024, ttl=300, negative_ttl=30,
+                 token_types=('access',)):
+        self.data_store = data_store
+        self.negative_ttl = negative_ttl
+        self.token_types = tuple(token_types)
+        self._consumers = LRUCache(size, ttl)
+        self._tokens = LRUCache(size, ttl)
+
+    def __getattr__(self, name):
+        return getattr(self.data_store, name)
+
+    def lookup_consumer(self, key):
+        consumer = self._consumers.get(key)
+        if consumer is LRUCache.MISSING:
+            consumer = self.data_store.lookup_consumer(key)
+            self._consumers.put(key, consumer,
+                                ttl=None if consumer else self.negative_ttl)
+        return consumer
+
+    def lookup_token(self, token_type, token_key):
+        if token_type not in self.token_types:
+            return self.data_store.lookup_token(token_type, token_key)
+
+        token = self._tokens.get((token_type, token_key))
+        if token is LRUCache.MISSING:
+            token = self.data_store.lookup_token(token_type, token_key)
+            self._tokens.put((token_type, token_key), token,
+                             ttl=None if token else self.negative_ttl)
+        return token
+
+    def fetch_access_token(self, *args, **kwargs):
+        # the request token is used up by this
+        token = args[1] if len(args) > 1 else kwargs.get('oauth_token')
+        if token is not None:
+            self.invalidate_token(token.key, 'request')
+        return self.data_store.fetch_access_token(*args, **kwargs)
+
+    def invalidate_consumer(self, key):
+        """Forget a consumer, eg. after revoking or changing it."""
+        self._consumers.pop(key)
+
+    def invalidate_token(self, token_key, token_type='access'):
+        """Forget a token, eg. after revoking it."""
+        self._tokens.pop((token_type, token_key))
+
+    def invalidate_all(self):
+        self._consumers.clear()
+        self._tokens.clear()
+
+    def cache_stats(self):
+        """Returns a dict of cache statistics."""
+        return {
+            'consumers':        len(self._consumers),
+            'consumer_hits':    self._consumers.hits,
+            'consumer_misses':  self._consumers.misses,
+            'tokens':           len(self._tokens),
+            'token_hits':       self._tokens.hits,
+            'token_misses':     self._tokens.misses,
+        }
+
+
+class MemoryNonceMixin():
+    """Keeps seen nonces in memory instead of asking the database.
+
+    Mix this into an OAuthDataStore subclass (ahead of it) to replace its
+    lookup_nonce(), or use MemoryNonceStore to wrap an existing data store.
+
+    Nonces are remembered in time buckets by the time they were seen, or
+    by the request's timestamp if that's later.  A replayed request is
+    rejected on its timestamp by OAuthServer once it's older than
+    timestamp_threshold (and so are timestamps further than that ahead),
+    so a nonce only has to be kept that long after both; whole buckets
+    are dropped as they age past it, which keeps memory bounded by the
+    request rate.
+
+    Note that this is per-process.
+    """
+    nonce_window = None     # seconds, defaults to OAuthServer.timestamp_threshold
+    nonce_buckets = 10      # number of buckets the window is split into
+    nonce_timestamps = True # OAuthServer passes the request's timestamp
+
+    _nonce_lock = None
+    _nonce_init_lock = threading.Lock()
+
+    def _nonce_init(self):
+        with self._nonce_init_lock:
+            if self._nonce_lock is None:
+                self._nonce_setup()
+
+    def _nonce_setup(self):
+        if self.nonce_window is None:
+            self.nonce_window = OAuthServer.timestamp_threshold
+        self._nonce_width = max(1, -(-int(self.nonce_window) // self.nonce_buckets))
+        # bucket number -> set of (consumer key, token key, nonce)
+        self._nonce_seen = {}
+        self._nonce_entries = 0
+        self._nonce_evictions = 0
+        self._nonce_replays = 0
+        # set last, it's what tells other threads we're ready
+        self._nonce_lock = threading.Lock()
+
+    def lookup_nonce(self, oauth_consumer, oauth_token, nonce, timestamp=None):
+        """Returns the nonce if it has been seen within the window,
+        otherwise records it and returns None.
+        """
+        if self._nonce_lock is None:
+            self._nonce_init()
+
+        key = (oauth_consumer.key, oauth_token.key if oauth_token else None, nonce)
+        now = int(time.time())
+        current = now // self._nonce_width
+        number = max(now, timestamp or 0) // self._nonce_width
+
+        with self._nonce_lock:
+            self._expire_nonces(current)
+            for seen in self._nonce_seen.values():
+                if key in seen:
+                    self._nonce_replays += 1
+                    return nonce
+
+            try:
+                bucket = self._nonce_seen[number]
+            except KeyError:
+                bucket = self._nonce_seen[number] = set()
+            bucket.add(key)
+            self._nonce_entries += 1
+        return None
+
+    def lookup_nonces(self, nonces):
+        return [self.lookup_nonce(*n) for n in nonces]
+
+    def _expire_nonces(self, current):
+        # one bucket of slack, since the current bucket is partially filled
+        oldest = current - self.nonce_buckets
+        for number in [n for n in self._nonce_seen if n < oldest]:
+            dropped = len(self._nonce_seen.pop(number))
+            self._nonce_entries -= dropped
+            self._nonce_evictions += dropped
+
+    def nonce_stats(self):
+        """Returns a dict of nonce cache statistics, for sizing."""
+        if self._nonce_lock is None:
+            self._nonce_init()
+        with self._nonce_lock:
+            return {
+                'entries':      self._nonce_entries,
+                'buckets':      len(self._nonce_seen),
+                'evictions':    self._nonce_evictions,
+                'replays':      self._nonce_replays,
+                'window':       self.nonce_window,
+                'bucket_width': self._nonce_width,
+            }
+
+
+class MemoryNonceStore(MemoryNonceMixin):
+    """Wraps any OAuthDataStore, answering lookup_nonce() from memory
+    and passing everything else through to the wrapped store.
+    """
+
+    def __init__(self, data_store, window=None, buckets=None):
+        self.data_store = data_store
+        if window is not None:
+            self.nonce_window = window
+        if buckets is not None:
+            self.nonce_buckets = buckets
+        self._nonce_init()
+
+    def __getattr__(self, name):
+        return getattr(self.data_store, name)
+
+
+class SharedNonceStore():
+    """Wraps any OAuthDataStore, answering lookup_nonce() from a table in
+    a memory-mapped file, so that every process on the host which opens
+    the same path sees the same nonces.
+
+    The table is a fixed number of slots, each holding a 64-bit nonce
+    fingerprint and the time it was seen (or the request's timestamp, if
+    that's later), using open addressing with linear probing.  A slot
+    older than the window is free for reuse.  Check-and-insert is done
+    under an exclusive lock on the file.
+
+    If all the slots within max_probe of a nonce are live, the nonce is
+    checked with the wrapped data store's lookup_nonce() instead, and
+    counted in 'overflows'; if that number is not zero, the table is too
+    small for the request rate.  Until such a nonce has expired, nonces
+    missing from the table are checked with the wrapped store as well.
+    """
+    MAGIC = b'PCNONCE2'
+    _header = struct.Struct('<8sQQQ')   # magic, slots, window, overflow expiry
+    _slot = struct.Struct('<QQ')        # fingerprint, time seen
+    max_probe = 32
+    nonce_timestamps = True     # OAuthServer passes the request's timestamp
+
+    def __init__(self, data_store, path, slots=65536, window=None):
+        if fcntl is None:
+            raise OAuthError('SharedNonceStore requires fcntl file locking')
+        self.data_store = data_store
+        self.path = path
+        self.slots = int(slots)
+        self.window = int(window if window is not None else OAuthServer.timestamp_threshold)
+        self._lock = threading.Lock()
+        self._replays = 0
+        self._overflows = 0
+
+        size = self._header.size + self.slots * self._slot.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            magic, slots, window, overflow_until = self._header.unpack_from(self._map, 0)
+            if magic != self.MAGIC:
+                # new, or laid out by an older version
+                self._map[:] = bytes(size)
+                self._header.pack_into(self._map, 0, self.MAGIC, self.slots, self.window, 0)
+            elif slots != self.slots or window != self.window:
+                raise OAuthError('Nonce table {} was created with {} slots and a {}s window'
+                                    .format(path, slots, window))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def __getattr__(self, name):
+        return getattr(self.data_store, name)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _fingerprint(self, oauth_consumer, oauth_token, nonce):
+        key = '\0'.join((str(oauth_consumer.key),
+                         str(oauth_token.key) if oauth_token else '',
+                         str(nonce)))
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        # zero marks a slot that has never been used
+        return int.from_bytes(digest, 'little') or 1
+
+    def lookup_nonce(self, oauth_consumer, oauth_token, nonce, timestamp=None):
+        """Returns the nonce if it has been seen within the window,
+        otherwise records it and returns None.
+        """
+        fingerprint = self._fingerprint(oauth_consumer, oauth_token, nonce)
+        now = int(time.time())
+        seen_at = max(now, timestamp or 0)
+        expired = now - self.window
+        start = fingerprint % self.slots
+
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                overflow_until = self._header.unpack_from(self._map, 0)[3]
+                free = None
+                for i in range(min(self.max_probe, self.slots)):
+                    offset = self._header.size + ((start + i) % self.slots) * self._slot.size
+                    seen_fp, seen = self._slot.unpack_from(self._map, offset)
+                    if seen == 0:
+                        # end of the probe chain
+                        if free is None:
+                            free = offset
+                        break
+                    if seen < expired:
+                        if free is None:
+                            free = offset
+                        continue
+                    if seen_fp == fingerprint:
+                        self._replays += 1
+                        return nonce
+
+                if free is not None:
+                    self._slot.pack_into(self._map, free, fingerprint, seen_at)
+                    if overflow_until < now:
+                        return None
+                else:
+                    # no room, and evicting a live nonce would let it be
+                    # replayed; the wrapped store has to be asked about
+                    # every new nonce until this one expires
+                    self._overflows += 1
+                    if seen_at + self.window > overflow_until:
+                        self._header.pack_into(self._map, 0, self.MAGIC, self.slots,
+                                               self.window, seen_at + self.window)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return self.data_store.lookup_nonce(oauth_consumer, oauth_token, nonce)
+
+    def lookup_nonces(self, nonces):
+        return [self.lookup_nonce(*n) for n in nonces]
+
+    def nonce_stats(self):
+        """Returns a dict of nonce table statistics.  'entries' is shared,
+        'replays' and 'overflows' are for this process only.
+        """
+        expired = int(time.time()) - self.window
+        entries = 0
+        for offset in range(self._header.size, len(self._map), self._slot.size):
+            if self._slot.unpack_from(self._map, offset)[1] >= expired:
+                entries += 1
+        return {
+            'entries':      entries,
+            'slots':        self.slots,
+            'replays':      self._replays,
+            'overflows':    self._overflows,
+            'window':       self.window,
+        }
+
+
 class OAuthSignatureMethod():
     """A strategy class that implements a signature method."""
+
+    # maximum number of escaped signing keys to remember
+    key_cache_size = 1024
+    _key_cache = None
+
     def get_name(self):
         """-> str."""
         raise NotImplementedError
@@ -730,7 +1216,29 @@ class OAuthSignatureMethod():
 
     def check_signature(self, oauth_request, consumer, token, signature):
         built = self.build_signature(oauth_request, consumer, token)
-        return built == signature
+        return hmac.compare_digest(_utf8_str(built), _utf8_str(signature))
+
+    def get_signing_key(self, consumer, token):
+        """Return the escaped 'consumer_secret&token_secret' key,
+        memoized per (consumer, token) secret pair.
+        """
+        if self._key_cache is None:
+            self._key_cache = {}
+        secrets = (consumer.secret, token.secret if token else None)
+        try:
+            return self._key_cache[secrets]
+        except KeyError:
+            pass
+
+        key = '%s&' % escape(consumer.secret)
+        if token:
+            key += escape(token.secret)
+
+        # crude bound, this only needs to keep the hot keys around
+        if len(self._key_cache) >= self.key_cache_size:
+            self._key_cache.clear()
+        self._key_cache[secrets] = key
+        return key
 
 
 class OAuthSignatureMethod_HMAC_SHA1(OAuthSignatureMethod):
@@ -739,16 +1247,8 @@ class OAuthSignatureMethod_HMAC_SHA1(OAuthSignatureMethod):
         return 'HMAC-SHA1'
 
     def build_signature_base_string(self, oauth_request, consumer, token):
-        sig = (
-            escape(oauth_request.get_normalized_http_method()),
-            escape(oauth_request.get_normalized_http_url()),
-            escape(oauth_request.get_normalized_parameters()),
-        )
-
-        key = '%s&' % escape(consumer.secret)
-        if token:
-            key += escape(token.secret)
-        raw = '&'.join(sig)
+        key = self.get_signing_key(consumer, token)
+        raw = oauth_request.get_signature_base_string()
         return key, raw
 
     def build_signature(self, oauth_request, consumer, token):
@@ -773,9 +1273,7 @@ class OAuthSignatureMethod_PLAINTEXT(OAuthSignatureMethod):
 
     def build_signature_base_string(self, oauth_request, consumer, token):
         """Concatenates the consumer key and secret."""
-        sig = '%s&' % escape(consumer.secret)
-        if token:
-            sig = sig + escape(token.secret)
+        sig = self.get_signing_key(consumer, token)
         return sig, sig
 
     def build_signature(self, oauth_request, consumer, token):
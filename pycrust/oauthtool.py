@@ -12,6 +12,30 @@ Configuration:
         tools.oauth.request_token_url = '/oauth1/request_token'
         tools.oauth.access_token_url  = '/oauth1/access_token'
         tools.oauth.datastore.class   = 'pycrust.oauth.OAuthDataStore'
+        tools.oauth.precheck          = True
+        tools.oauth.datastore.cache.on  = False
+        tools.oauth.datastore.cache.size = 1024
+        tools.oauth.datastore.cache.ttl = 300
+        tools.oauth.datastore.cache.negative_ttl = 30
+        tools.oauth.nonce_cache.on    = False
+        tools.oauth.nonce_cache.buckets = 10
+        tools.oauth.nonce_cache.path  = None
+        tools.oauth.nonce_cache.slots = 65536
+
+Setting tools.oauth.nonce_cache.on answers nonce lookups from an
+in-process cache (pycrust.oauth.MemoryNonceStore) rather than calling
+the datastore's lookup_nonce() for every request.  When running several
+processes on one host, also set tools.oauth.nonce_cache.path to a file
+they all share (pycrust.oauth.SharedNonceStore), so a nonce seen by one
+process is rejected by the others.
+
+With tools.oauth.precheck on, requests with no OAuth Authorization header
+and no oauth_ parameter in the query string or body are passed over
+before any parsing; OAuthTool.precheck_stats() reports how many.
+
+Setting tools.oauth.datastore.cache.on caches consumer and access token
+lookups (pycrust.oauth.CachingDataStore); call invalidate_consumer() or
+invalidate_token() on the tool's datastore when revoking them.
 
 You really should override tools.oauth.datastore.class if you want
 this to work :)
@@ -22,44 +46,168 @@ under the MIT license, please see LICENSE.gearshift for details.
 
 """
 
-import cherrypy, logging
-from six.moves import urllib
+import cherrypy, logging, threading
 
 from pycrust import load_class, oauth
 
+def load_datastore(config, app, ds_classname, toolname):
+    """Creates the configured datastore, wrapped in whichever
+    caches have been turned on.
+    """
+    ds_class = load_class(ds_classname)
+    if not callable(ds_class):
+        raise TypeError("datastore class '{}' is not callable".format(ds_classname))
+    datastore = ds_class(app=app)
+    cherrypy.log("{} loaded auth datastore class {}".format(toolname, ds_classname),
+                    context='ENGINE', severity=logging.INFO)
+
+    if config.get('tools.oauth.datastore.cache.on', False):
+        datastore = oauth.CachingDataStore(datastore,
+                size=config.get('tools.oauth.datastore.cache.size', 1024),
+                ttl=config.get('tools.oauth.datastore.cache.ttl', 300),
+                negative_ttl=config.get('tools.oauth.datastore.cache.negative_ttl', 30))
+        cherrypy.log("{} caching consumer and token lookups".format(toolname),
+                        context='ENGINE', severity=logging.INFO)
+
+    if config.get('tools.oauth.nonce_cache.on', False):
+        nonce_path = config.get('tools.oauth.nonce_cache.path')
+        if nonce_path:
+            datastore = oauth.SharedNonceStore(datastore, nonce_path,
+                    slots=config.get('tools.oauth.nonce_cache.slots', 65536))
+        else:
+            datastore = oauth.MemoryNonceStore(datastore,
+                    buckets=config.get('tools.oauth.nonce_cache.buckets'))
+        cherrypy.log("{} using nonce cache {}".format(toolname, nonce_path or 'in memory'),
+                        context='ENGINE', severity=logging.INFO)
+
+    return datastore
+
+
+def request_url(request=None):
+    """Returns the scheme://host/path URL of the request,
+    as the client saw it.
+    """
+    if request is None:
+        request = cherrypy.request
+    host = request.headers.get("X-Forwarded-Host") or request.headers.get("Host")
+    return "{}://{}{}{}".format(request.scheme, host, request.script_name, request.path_info)
+
+
+def body_params(request):
+    """Returns the parameters parsed from the request body.
+    (request.body_params went away in CherryPy 3.2)
+    """
+    body = getattr(request, 'body', None)
+    if body is not None and hasattr(body, 'params'):
+        return body.params
+    return getattr(request, 'body_params', None)
+
+
+class LazyURLMixin(object):
+    """Works out http_url from the CherryPy request the first time it's
+    used, which is only when a signature has to be checked.
+    """
+    _http_url = None
+    _cp_request = None
+
+    @classmethod
+    def for_request(cls, request, parameters):
+        oauth_request = cls(request.method, None, parameters)
+        oauth_request._cp_request = request
+        return oauth_request
+
+    @property
+    def http_url(self):
+        if self._http_url is None and self._cp_request is not None:
+            self._http_url = request_url(self._cp_request)
+        return self._http_url
+
+    @http_url.setter
+    def http_url(self, value):
+        self._http_url = value
+
+
+class ToolOAuthRequest(LazyURLMixin, oauth.OAuthRequest):
+    pass
+
+class ToolOAuth2Request(LazyURLMixin, oauth.OAuth2Request):
+    pass
+
+
+def _send_token(tokstr):
+    """Tell CherryPy that we have processed the request,
+    with the given token string as the response.
+    """
+    if not isinstance(tokstr, bytes):
+        tokstr = tokstr.encode('utf-8')
+    cherrypy.response.body = [tokstr]
+    cherrypy.request.handler = None
+
+    # Delete Content-Length header so finalize() recalcs it.
+    cherrypy.response.headers.pop("Content-Length", None)
+
+
 class OAuthTool(cherrypy.Tool):
-    def __init__(self, app=''):
+    def __init__(self, app='', apps=None):
         """Optional argument 'app' will cause this to read
         the config from only the app in question, and base all
-        paths on it"""
+        paths on it.  Alternatively 'apps' lists several mounted
+        apps for this one tool to serve, the first being the default.
+
+        The endpoint paths of every app are put in one table up front,
+        so a request only costs a dict lookup to route.
+        """
+        apps = list(apps or [app])
+
+        # app -> (realm, server), and path -> (endpoint method, app)
+        self.apps   = {}
+        self.routes = {}
+        for name in apps:
+            self.add_app(name)
 
         # the config is a little buried, annoyingly
-        config = cherrypy.tree.apps[app].config['/']
+        config = cherrypy.tree.apps[apps[0]].config['/']
 
-        self.realm              = config.get('tools.oauth.realm')
-        self.request_token_url  = app + config.get('tools.oauth.request_token.url',    '/oauth1/request_token')
-        self.access_token_url   = app + config.get('tools.oauth.access_token.url',     '/oauth1/access_token')
-        ds_classname            = config.get('tools.oauth.datastore.class', 'pycrust.oauth.OAuthDataStore')
-
-        # load datastore class
-        ds_class = load_class(ds_classname)
-        if not callable(ds_class):
-            raise TypeError("datastore class '{}' is not callable".format(ds_classname))
-        self.datastore = ds_class(app=app)
-        cherrypy.log("OAuthTool loaded auth datastore class {}".format(ds_classname),
-                        context='ENGINE', severity=logging.INFO)
+        self.default_app        = apps[0]
+        self.realm, self.oauth_server = self.apps[apps[0]]
+        self.datastore          = self.oauth_server.data_store
+        self.request_token_url  = apps[0] + config.get('tools.oauth.request_token.url',    '/oauth1/request_token')
+        self.access_token_url   = apps[0] + config.get('tools.oauth.access_token.url',     '/oauth1/access_token')
+        self.precheck           = config.get('tools.oauth.precheck', True)
 
-        self.oauth_server = oauth.OAuthServer(self.datastore)
-        self.oauth_server.add_signature_method(oauth.OAuthSignatureMethod_PLAINTEXT())
-        self.oauth_server.add_signature_method(oauth.OAuthSignatureMethod_HMAC_SHA1())
+        # requests passed over by the precheck, and requests parsed
+        self.skipped    = 0
+        self.inspected  = 0
+        self._stats_lock = threading.Lock()
 
         cherrypy.log("OAuthTool initialized", context='ENGINE', severity=logging.INFO)
 
         super().__init__(point='before_handler', callable=self.before_handler, priority=10)
 
 
-    def send_oauth_error(self, msg, code=401):
-        header = oauth.build_authenticate_header(realm=self.realm)
+    def add_app(self, app):
+        """Reads the OAuth config of a mounted app, and adds its
+        endpoints to the routing table.
+        """
+        config = cherrypy.tree.apps[app].config['/']
+
+        realm           = config.get('tools.oauth.realm')
+        ds_classname    = config.get('tools.oauth.datastore.class', 'pycrust.oauth.OAuthDataStore')
+        datastore       = load_datastore(config, app, ds_classname, 'OAuthTool')
+
+        server = oauth.OAuthServer(datastore)
+        server.add_signature_method(oauth.OAuthSignatureMethod_PLAINTEXT())
+        server.add_signature_method(oauth.OAuthSignatureMethod_HMAC_SHA1())
+
+        self.apps[app] = (realm, server)
+        self.routes[app + config.get('tools.oauth.request_token.url', '/oauth1/request_token')] = \
+                (self.request_token, app)
+        self.routes[app + config.get('tools.oauth.access_token.url', '/oauth1/access_token')] = \
+                (self.access_token, app)
+
+
+    def send_oauth_error(self, msg, code=401, realm=None):
+        header = oauth.build_authenticate_header(realm=realm or self.realm)
         for k, v in header.items():
             cherrypy.response.headers[k] = v
 
@@ -67,111 +215,141 @@ class OAuthTool(cherrypy.Tool):
         raise cherrypy.HTTPError(code)
 
 
+    def is_oauth_request(self, request):
+        """Cheap test for whether the request could be carrying OAuth
+        parameters at all, without parsing anything.
+        """
+        if request.headers.get('Authorization', '')[:6] == 'OAuth ':
+            return True
+        if 'oauth_' in request.query_string:
+            return True
+        body = body_params(request)
+        if body:
+            for key in body:
+                if key[:6] == 'oauth_':
+                    return True
+        return False
+
+    def precheck_stats(self):
+        """Returns a dict of how many requests were skipped by
+        the precheck versus inspected.
+        """
+        with self._stats_lock:
+            skipped, inspected = self.skipped, self.inspected
+        total = skipped + inspected
+        return {
+            'skipped':      skipped,
+            'inspected':    inspected,
+            'skip_ratio':   float(skipped) / total if total else 0.0,
+        }
+
     def before_handler(self, **kwargs):
-        headers = cherrypy.request.headers.copy()
-
-        params = urllib.parse.parse_qs(cherrypy.request.query_string)
-        if cherrypy.request.body_params:
-            params.update(cherrypy.request.body_params)
-
-        # figure out the real URL
-        host = cherrypy.request.headers.get("X-Forwarded-Host") or cherrypy.request.headers.get("Host")
-        url = "{}://{}{}{}".format(
-                    cherrypy.request.scheme,
-                    host,
-                    cherrypy.request.script_name,
-                    cherrypy.request.path_info)
-
-        oauth_request = oauth.OAuthRequest.from_request(
-                http_method=cherrypy.request.method,
-                http_url=url,
-                headers=headers,
-                parameters=params,
-                query_string=cherrypy.request.query_string,
+        request = cherrypy.request
+        if self.precheck and not self.is_oauth_request(request):
+            with self._stats_lock:
+                self.skipped += 1
+            return
+        with self._stats_lock:
+            self.inspected += 1
+
+        body = body_params(request)
+        params = oauth.OAuthRequest.parse_parameters(
+                authorization=request.headers.get('Authorization'),
+                query_string=request.query_string,
+                parameters=dict(body) if body else None,
             )
 
         # nothing for us to do here
-        if not oauth_request or not 'oauth_consumer_key' in oauth_request.parameters:
+        if not 'oauth_consumer_key' in params:
             return
 
-        cherrypy.request.oauth_request = oauth_request
-        cherrypy.request.oauth_server = self.oauth_server
+        endpoint, app = self.routes.get(request.script_name + request.path_info,
+                                        (None, request.script_name))
+        realm, server = self.apps.get(app) or self.apps[self.default_app]
+
+        oauth_request = ToolOAuthRequest.for_request(request, params)
+        request.oauth_request = oauth_request
+        request.oauth_server = server
 
         # Remove any oauth-related params from the request, so that
         # those params don't get passed around and confuse handlers.
-        for key in list(cherrypy.request.params.keys()):
+        for key in list(request.params.keys()):
             if key.startswith('oauth_'):
-                del(cherrypy.request.params[key])
+                del(request.params[key])
 
-        uri = cherrypy.request.script_name + cherrypy.request.path_info
+        if endpoint:
+            endpoint(oauth_request, server, realm)
 
-        # this is an OAuth1 request token request
-        if uri == self.request_token_url:
 
-            try:
-                # create a request token
-                token = self.oauth_server.fetch_request_token(oauth_request)
-            except oauth.OAuthError as e:
-                return self.send_oauth_error("request error: {}".format(e.message))
+    def request_token(self, oauth_request, server, realm):
+        """OAuth1 request token endpoint"""
+        try:
+            # create a request token
+            token = server.fetch_request_token(oauth_request)
+        except oauth.OAuthError as e:
+            return self.send_oauth_error("request error: {}".format(e.message), realm=realm)
 
-            # Tell CherryPy that we have processed the request
-            tokstr = token.to_string()
-            if not isinstance(tokstr, bytes):
-                tokstr = tokstr.encode('utf-8')
-            cherrypy.response.body = [tokstr]
-            cherrypy.request.handler = None
+        _send_token(token.to_string())
 
-            # Delete Content-Length header so finalize() recalcs it.
-            cherrypy.response.headers.pop("Content-Length", None)
 
-        # this is an OAuth1 access token request
-        elif uri == self.access_token_url:
-            try:
-                token = self.oauth_server.fetch_access_token(oauth_request)
-            except oauth.OAuthError as e:
-                return self.send_oauth_error("auth error: {}".format(e.message))
+    def access_token(self, oauth_request, server, realm):
+        """OAuth1 access token endpoint"""
+        try:
+            token = server.fetch_access_token(oauth_request)
+        except oauth.OAuthError as e:
+            return self.send_oauth_error("auth error: {}".format(e.message), realm=realm)
 
-            tokstr = token.to_string()
-            if not isinstance(tokstr, bytes):
-                tokstr = tokstr.encode('utf-8')
-            cherrypy.response.body = [tokstr]
-            cherrypy.request.handler = None
-            cherrypy.response.headers.pop("Content-Length", None)
+        _send_token(token.to_string())
 
 
 class OAuth2Tool(cherrypy.Tool):
-    def __init__(self, app=''):
+    def __init__(self, app='', apps=None):
         """Optional argument 'app' will cause this to read
         the config from only the app in question, and base all
-        paths on it"""
+        paths on it.  Alternatively 'apps' lists several mounted
+        apps for this one tool to serve, the first being the default.
+        """
+        apps = list(apps or [app])
+
+        # app -> (realm, server, token_url), and path -> (endpoint method, app)
+        self.apps   = {}
+        self.routes = {}
+        for name in apps:
+            self.add_app(name)
+
+        self.realm, self.oauth_server, self.token_url = self.apps[apps[0]]
+        self.datastore = self.oauth_server.data_store
+        self.authorize_url = apps[0] + cherrypy.tree.apps[apps[0]].config['/'].get(
+                'tools.oauth2.oauth_authorize_url', '/oauth2/authorize')
 
-        # the config is a little buried, annoyingly
-        config = cherrypy.tree.apps[app].config['/']
+        cherrypy.log("OAuth2Tool initialized", context='ENGINE', severity=logging.INFO)
 
-        self.realm          = config.get('tools.oauth.realm')
-        self.token_url      = app + config.get('tools.oauth2.oauth_token_url',     '/oauth2/token')
-        self.authorize_url  = app + config.get('tools.oauth2.oauth_authorize_url', '/oauth2/authorize')
-        ds_classname        = config.get('tools.oauth.datastore.class', 'pycrust.oauth.OAuthDataStore')
-
-        # load datastore class
-        ds_class = load_class(ds_classname)
-        if not callable(ds_class):
-            raise TypeError("datastore class '{}' is not callable".format(ds_classname))
-        self.datastore = ds_class(app=app)
-        cherrypy.log("OAuth2Tool loaded auth datastore class {}".format(ds_classname),
-                        context='ENGINE', severity=logging.INFO)
+        super().__init__(point='before_handler', callable=self.before_handler, priority=10)
 
-        self.oauth_server = oauth.OAuth2Server(self.datastore)
-        self.oauth_server.add_signature_method(oauth.OAuthSignatureMethod_PLAINTEXT())
-        self.oauth_server.add_signature_method(oauth.OAuthSignatureMethod_HMAC_SHA1())
 
-        cherrypy.log("OAuth2Tool initialized", context='ENGINE', severity=logging.INFO)
+    def add_app(self, app):
+        """Reads the OAuth2 config of a mounted app, and adds its
+        endpoints to the routing table.
+        """
+        config = cherrypy.tree.apps[app].config['/']
 
-        super().__init__(point='before_handler', callable=self.before_handler, priority=10)
+        realm           = config.get('tools.oauth.realm')
+        token_url       = app + config.get('tools.oauth2.oauth_token_url',     '/oauth2/token')
+        authorize_url   = app + config.get('tools.oauth2.oauth_authorize_url', '/oauth2/authorize')
+        ds_classname    = config.get('tools.oauth.datastore.class', 'pycrust.oauth.OAuthDataStore')
+        datastore       = load_datastore(config, app, ds_classname, 'OAuth2Tool')
 
+        server = oauth.OAuth2Server(datastore)
+        server.add_signature_method(oauth.OAuthSignatureMethod_PLAINTEXT())
+        server.add_signature_method(oauth.OAuthSignatureMethod_HMAC_SHA1())
 
-    def send_oauth_error(self, msg, code=401):
-        header = oauth.build_authenticate_header(realm=self.realm)
+        self.apps[app] = (realm, server, token_url)
+        self.routes[authorize_url] = (self.authorize, app)
+        self.routes[token_url] = (self.token, app)
+
+
+    def send_oauth_error(self, msg, code=401, realm=None):
+        header = oauth.build_authenticate_header(realm=realm or self.realm)
         for k, v in header.items():
             cherrypy.response.headers[k] = v
 
@@ -180,91 +358,71 @@ class OAuth2Tool(cherrypy.Tool):
 
 
     def before_handler(self, **kwargs):
-        headers = cherrypy.request.headers.copy()
-
-        params = urllib.parse.parse_qs(cherrypy.request.query_string)
-        if cherrypy.request.body_params:
-            params.update(cherrypy.request.body_params)
-
-        # figure out the real URL
-        host = cherrypy.request.headers.get("X-Forwarded-Host") or cherrypy.request.headers.get("Host")
-        url = "{}://{}{}{}".format(
-                    cherrypy.request.scheme,
-                    host,
-                    cherrypy.request.script_name,
-                    cherrypy.request.path_info)
-
-        uri = cherrypy.request.script_name + cherrypy.request.path_info
-        if uri == self.authorize_url:
-            if not 'response_type' in params or params['response_type'][0] != 'code':
-                self.send_oauth_error("Invalid or missing parameter 'response_type'", 404)
-
-            oauth_request = oauth.OAuth2Request.from_request(
-                    http_method=cherrypy.request.method,
-                    http_url=url,
-                    headers=headers,
-                    parameters=params,
-                    query_string=cherrypy.request.query_string,
-                )
+        request = cherrypy.request
 
-            try:
-                token = self.oauth_server.fetch_request_token(oauth_request)
-            except oauth.OAuthError as e:
-                return self.send_oauth_error("request error: {}".format(e.message))
+        try:
+            endpoint, app = self.routes[request.script_name + request.path_info]
+        except KeyError:
+            return
 
-            # client might be redirected to a local auth server
-            if 'redirect_uri' in params:
-                target_url = params['redirect_uri']
-            else:
-                target_url = self.token_url
+        body = body_params(request)
+        params = oauth.OAuth2Request.parse_parameters(
+                authorization=request.headers.get('Authorization'),
+                query_string=request.query_string,
+                parameters=dict(body) if body else None,
+            )
+        oauth_request = ToolOAuth2Request.for_request(request, params)
 
-            # generate a 302 response
-            rsp = target_url + '?code={}'.format(token.key)
-            if 'state' in params:
-                rsp += '&state={}'.format(params['state'])
-            if 'scope' in params:
-                rsp += '&scope={}'.format(params['scope'])
+        endpoint(oauth_request, *self.apps[app])
 
-            raise cherrypy.HTTPRedirect(rsp, 302)
 
+    def authorize(self, oauth_request, realm, server, token_url):
+        """OAuth2 authorization endpoint"""
+        params = oauth_request.parameters
+        if params.get('response_type') != 'code':
+            self.send_oauth_error("Invalid or missing parameter 'response_type'", 404, realm=realm)
 
-        elif uri == self.token_url:
+        try:
+            token = server.fetch_request_token(oauth_request)
+        except oauth.OAuthError as e:
+            return self.send_oauth_error("request error: {}".format(e.message), realm=realm)
 
-            oauth_request = oauth.OAuth2Request.from_request(
-                    http_method=cherrypy.request.method,
-                    http_url=url,
-                    headers=headers,
-                    parameters=params,
-                    query_string=cherrypy.request.query_string,
-                )
+        # client might be redirected to a local auth server
+        if 'redirect_uri' in params:
+            target_url = params['redirect_uri']
+        else:
+            target_url = token_url
 
-            grant_type = oauth_request.get_parameter('grant_type')
+        # generate a 302 response
+        rsp = target_url + '?code={}'.format(token.key)
+        if 'state' in params:
+            rsp += '&state={}'.format(params['state'])
+        if 'scope' in params:
+            rsp += '&scope={}'.format(params['scope'])
 
-            token = None
-            if grant_type == 'authorization_code':
-                try:
-                    token = self.oauth_server.fetch_access_token(oauth_request)
-                except oauth.OAuthError as e:
-                    return self.send_oauth_error("authorization_code auth error: {}".format(e.message))
+        raise cherrypy.HTTPRedirect(rsp, 302)
 
-            elif grant_type == 'client_credentials':
-                try:
-                    token = self.oauth_server.authenticate_client_credentials(oauth_request)
-                except oauth.OAuthError as e:
-                    return self.send_oauth_error("client_credentials auth error: {}".format(e.message))
 
-            else:
-                return self.send_oauth_error("bad value for grant_type")
+    def token(self, oauth_request, realm, server, token_url):
+        """OAuth2 token endpoint"""
+        grant_type = oauth_request.get_parameter('grant_type')
 
-            # return this as JSON rather than an encoded query string,
-            # so we can easily parse it with Google's java oauth library.
-            tokstr = token.to_json2()
-            if not isinstance(tokstr, bytes):
-                tokstr = tokstr.encode('utf-8')
-            cherrypy.response.body = [tokstr]
+        token = None
+        if grant_type == 'authorization_code':
+            try:
+                token = server.fetch_access_token(oauth_request)
+            except oauth.OAuthError as e:
+                return self.send_oauth_error("authorization_code auth error: {}".format(e.message), realm=realm)
 
-            # Tell CherryPy that we have processed the request
-            cherrypy.request.handler = None
-            cherrypy.response.headers.pop("Content-Length", None)
+        elif grant_type == 'client_credentials':
+            try:
+                token = server.authenticate_client_credentials(oauth_request)
+            except oauth.OAuthError as e:
+                return self.send_oauth_error("client_credentials auth error: {}".format(e.message), realm=realm)
 
+        else:
+            return self.send_oauth_error("bad value for grant_type", realm=realm)
 
+        # return this as JSON rather than an encoded query string,
+        # so we can easily parse it with Google's java oauth library.
+        _send_token(token.to_json2())
@@ -3,6 +3,91 @@
 saplugin is a CherryPy plugin for SQLAlchemy.  See the
 documentation in pycrust.satool for instructions.
 
+Engine and pool options can be given to the plugin directly:
+
+    SAEnginePlugin(cherrypy.engine, "postgresql://...",
+                   engine_options={'pool_size': 20, 'max_overflow': 10})
+
+or in the global CherryPy config, prefixed with 'sqlalchemy.':
+
+    sqlalchemy.pool_size     = 20
+    sqlalchemy.max_overflow  = 10
+    sqlalchemy.pool_recycle  = 3600
+    sqlalchemy.pool_pre_ping = True
+    sqlalchemy.pool_timeout  = 30
+
+Pool statistics (connections checked out, overflow, time spent waiting
+for a connection, and a histogram of checkout times) are returned by
+publishing 'db-stats' on the bus, and if stats_interval is set they are
+also published every stats_interval seconds on 'db-pool-stats'.
+PoolStatus is a handler which serves them as JSON.
+
+Several databases can be used at once by giving each plugin a name.
+A named plugin listens on 'bind-session-<name>' and
+'commit-session-<name>' instead, and also takes options from
+'sqlalchemy.<name>.' keys, which override the shared ones:
+
+    SAEnginePlugin(cherrypy.engine, "postgresql://.../accounts", name='accounts').subscribe()
+    SAEnginePlugin(cherrypy.engine, "postgresql://.../events", name='events').subscribe()
+
+    sqlalchemy.pool_size        = 10
+    sqlalchemy.events.pool_size = 50
+
+See pycrust.satool for using them from handlers.
+
+Read traffic can be sent to replicas of the database:
+
+    SAEnginePlugin(cherrypy.engine, "postgresql://primary/db",
+                   replicas=["postgresql://replica1/db",
+                             "postgresql://replica2/db"],
+                   replica_policy='least-checked-out')
+
+Sessions bound with read_only=True (see tools.db.read_only in
+pycrust.satool) are rolled back rather than committed, and run their
+queries on a replica, picked round-robin or by fewest connections
+checked out; anything they flush still goes to the primary, and so
+does everything after it in that session.
+A replica whose connections fail is taken out of rotation until
+check_interval seconds have passed and it answers again; with no
+replicas up, reads go to the primary.
+
+Query instrumentation is turned on with query_stats=True:
+
+    SAEnginePlugin(cherrypy.engine, "postgresql://...", query_stats=True,
+                   slow_query_time=0.5, repeat_threshold=20)
+
+Each request then has cherrypy.request.db_queries, a QueryLog of how
+many queries it made, the time they took and the slowest of them.
+Queries slower than slow_query_time are logged, as is any statement a
+single request runs repeat_threshold times (usually an N+1 pattern,
+loading related rows one at a time).  Totals for the process are
+returned by publishing 'db-query-stats' on the bus.
+
+Results of queries which are run often and rarely change can be
+cached, with result_cache_size set to the number of results to keep:
+
+    SAEnginePlugin(cherrypy.engine, "postgresql://...",
+                   result_cache_size=1000, result_cache_ttl=300)
+
+    rows = cherrypy.request.db.execute_cached(select(Country.__table__))
+
+Results are keyed on the compiled statement, whether it is an ORM or
+a Core one, and its parameters, and are dropped when they expire, or
+when a session from this plugin commits a write to one of the tables
+they came from.  Writes made through textual SQL can't be traced to
+tables, so they drop everything, and textual SQL is only cached when
+execute_cached() is given the tables it reads.  Only writes made by
+this process are seen, so result_cache_ttl bounds how stale results
+can get otherwise.
+Statements which load ORM entities, which belong to the session that
+loaded them, are always run rather than cached.
+
+A result is cached from whatever the session that ran it could see.
+Under REPEATABLE READ or SERIALIZABLE isolation that is the snapshot
+its transaction started with, so a row committed elsewhere meanwhile
+can be missing from it until it expires, even though the commit
+invalidated the tables before the result was stored.
+
 """
 #
 # This file is based on Sylvain Hellegouarch's post:
@@ -10,15 +95,445 @@ documentation in pycrust.satool for instructions.
 #
 # All credit goes to Sylvain for this.
 #
+import collections
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
 import cherrypy
 from cherrypy.process import wspbus, plugins
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy import Table
+from sqlalchemy.orm import Session, object_mapper, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.expression import TextClause, TextualSelect, UpdateBase
+
+from pycrust.cache import LRUCache
+
+__all__ = ['SAEnginePlugin', 'RoutingSession', 'SessionRegistry', 'PoolStats', 'PoolStatus',
+           'QueryLog', 'QueryStats', 'ResultCache', 'get_plugin', 'pool_status']
+
+
+class PoolStats(object):
+    """Connection pool statistics for one engine"""
+
+    # upper bounds of the checkout time histogram buckets, in seconds
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.histogram = [0] * (len(self.buckets) + 1)
+
+    def record_checkout(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            if seconds > self.wait_max:
+                self.wait_max = seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            self.histogram[i] += 1
+
+    def record_checkin(self, *args):
+        with self._lock:
+            self.checkins += 1
+
+    def snapshot(self, pool=None):
+        """Returns the statistics as a dict, along with the
+        current state of the pool if it's given.
+        """
+        with self._lock:
+            stats = {
+                'checkouts':    self.checkouts,
+                'checkins':     self.checkins,
+                'wait_total':   self.wait_total,
+                'wait_max':     self.wait_max,
+                'wait_avg':     self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'histogram':    dict(zip(['<={}'.format(b) for b in self.buckets] + ['>{}'.format(self.buckets[-1])],
+                                         self.histogram)),
+            }
+        if pool is not None:
+            stats['pool'] = type(pool).__name__
+            for name in ('size', 'checkedout', 'overflow', 'checkedin'):
+                # SingletonThreadPool's size is a plain attribute
+                if callable(getattr(pool, name, None)):
+                    stats[name] = getattr(pool, name)()
+        return stats
+
+
+class QueryLog(object):
+    """The queries made during one request"""
+
+    def __init__(self, keep=5):
+        self.keep = keep
+        self.count = 0
+        self.time = 0.0
+        self.slowest = []    # heap of (seconds, statement)
+        self.statements = collections.Counter()
+
+    def record(self, statement, seconds):
+        """Adds a query, returns how many times this request has run it"""
+        self.add_time(statement, seconds)
+        self.statements[statement] += 1
+        return self.statements[statement]
+
+    def add_time(self, statement, seconds):
+        self.count += 1
+        self.time += seconds
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, (seconds, statement))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, statement))
+
+    def snapshot(self):
+        return {
+            'count':    self.count,
+            'time':     self.time,
+            'slowest':  [{'time': t, 'statement': st} for t, st in sorted(self.slowest, reverse=True)],
+        }
+
+
+class QueryStats(object):
+    """Query statistics for one plugin, across all requests"""
+
+    def __init__(self, keep=10):
+        self._lock = threading.Lock()
+        self.log = QueryLog(keep)
+        self.slow = 0
+        self.repeated = collections.Counter()
+
+    def record(self, statement, seconds, slow=False):
+        with self._lock:
+            self.log.add_time(statement, seconds)
+            if slow:
+                self.slow += 1
+
+    def record_repeated(self, statement):
+        with self._lock:
+            self.repeated[statement] += 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = self.log.snapshot()
+            stats['slow'] = self.slow
+            stats['repeated'] = [{'requests': n, 'statement': st}
+                                 for st, n in self.repeated.most_common(self.log.keep)]
+        return stats
+
+
+class ResultCache(object):
+    """
+    Query results, dropped a table at a time: each result remembers
+    the generation of the tables it read, and a write to a table moves
+    it on to the next generation.
+    """
+
+    def __init__(self, size=1024, ttl=300):
+        self.cache = LRUCache(size, ttl)
+        self._lock = threading.Lock()
+        self._generations = {}    # table name -> generation
+        self._epoch = 0           # moved on by writes to unknown tables
+        self.stale = 0
+
+    def versions(self, tables):
+        generations = self._generations
+        return (self._epoch,) + tuple(generations.get(t, 0) for t in tables)
+
+    def get(self, key, tables):
+        """Returns the cached rows, or LRUCache.MISSING"""
+        entry = self.cache.get(key)
+        if entry is LRUCache.MISSING:
+            return entry
+        versions, rows = entry
+        if versions != self.versions(tables):
+            self.stale += 1
+            self.cache.pop(key)
+            return LRUCache.MISSING
+        return rows
+
+    def put(self, key, versions, rows, ttl=None):
+        """Caches rows, with the table versions from before they were read"""
+        self.cache.put(key, (versions, rows), ttl)
+
+    def invalidate(self, tables=None):
+        """Drops results from the given tables, or from all of them"""
+        with self._lock:
+            if tables is None:
+                self._epoch += 1
+            else:
+                for table in tables:
+                    self._generations[table] = self._generations.get(table, 0) + 1
+
+    def stats(self):
+        return {
+            'size':     len(self.cache),
+            'hits':     self.cache.hits - self.stale,
+            'misses':   self.cache.misses + self.stale,
+            'stale':    self.stale,
+        }
+
+
+def _statement_tables(statement):
+    """The names of the tables a statement reads"""
+    return set(element.fullname for element in visitors.iterate(statement)
+               if isinstance(element, Table))
+
+
+def _loads_entities(statement):
+    """Whether an ORM statement's rows hold mapped objects"""
+    for column in getattr(statement, 'column_descriptions', ()):
+        target = inspect(column.get('expr'), raiseerr=False)
+        if getattr(target, 'is_mapper', False) or getattr(target, 'is_aliased_class', False):
+            return True
+    return False
+
+
+class _TimedPoolMixin(object):
+    """Times how long each connection checkout takes, including any
+    wait for a free connection.
+    """
+    _pool_stats = None
+
+    def connect(self):
+        start = time.time()
+        try:
+            return super(_TimedPoolMixin, self).connect()
+        finally:
+            if self._pool_stats is not None:
+                self._pool_stats.record_checkout(time.time() - start)
+
+    def recreate(self):
+        pool = super(_TimedPoolMixin, self).recreate()
+        pool._pool_stats = self._pool_stats
+        return pool
+
+# pool class -> timed subclass
+_timed_pool_classes = {}
+
+def _timed_pool_class(poolclass):
+    try:
+        return _timed_pool_classes[poolclass]
+    except KeyError:
+        timed = _timed_pool_classes[poolclass] = type(
+                    'Timed' + poolclass.__name__, (_TimedPoolMixin, poolclass), {})
+        return timed
+
+def _default_pool_class(connection_string):
+    """The pool class SQLAlchemy would pick for this database"""
+    url = make_url(connection_string)
+    dialect = url.get_dialect()
+    if hasattr(dialect, 'get_pool_class'):
+        return dialect.get_pool_class(url)
+    return getattr(dialect, 'poolclass', None) or QueuePool
+
+
+class Replica(object):
+    """A replica engine and its health"""
+
+    def __init__(self, engine, stats):
+        self.engine = engine
+        self.stats = stats
+        self.down_since = None
+        self.last_checked = None
+        self._checking = False
+        self._lock = threading.Lock()
+
+    @property
+    def up(self):
+        return self.down_since is None
+
+    def checkedout(self):
+        pool = self.engine.pool
+        return pool.checkedout() if hasattr(pool, 'checkedout') else 0
+
+    def mark_down(self):
+        with self._lock:
+            now = time.time()
+            if self.down_since is None:
+                self.down_since = now
+            self.last_checked = now
+
+    def check(self):
+        """Tries the replica, bringing it back into rotation if it answers"""
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+        except Exception:
+            self.mark_down()
+            return False
+        with self._lock:
+            self.down_since = None
+            self.last_checked = None
+        return True
+
+    def recover(self, interval):
+        """
+        Whether the replica is up, checking a down one if it hasn't
+        been tried for interval seconds.  Only one thread checks at
+        a time; the others carry on without it.
+        """
+        with self._lock:
+            if self.down_since is None:
+                return True
+            if self._checking or time.time() - self.last_checked < interval:
+                return False
+            self._checking = True
+        try:
+            return self.check()
+        finally:
+            with self._lock:
+                self._checking = False
+
+
+def _is_write(clause):
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        words = clause.text.split(None, 1)
+        return bool(words) and words[0].upper() not in ('SELECT', 'WITH')
+    return False
+
+
+class RoutingSession(Session):
+    """
+    A session which runs its queries on a replica when it's read-only,
+    and on the primary once it's written anything.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        info = self.info
+        if self._flushing or _is_write(clause):
+            info['wrote'] = True
+            if 'result_cache' in info and not self._flushing:
+                self._wrote_tables([clause.table.fullname] if isinstance(clause, UpdateBase) else None)
+        elif info.get('router') and info.get('read_only') and not (info.get('wrote') or info.get('primary')):
+            if 'replica' not in info:
+                info['replica'] = info['router'].choose_replica()
+            if info['replica'] is not None:
+                return info['replica']
+        return super(RoutingSession, self).get_bind(mapper=mapper, clause=clause, **kw)
+
+    def _wrote_tables(self, tables):
+        """Notes tables to drop cached results from, None for all of them"""
+        info = self.info
+        if tables is None:
+            info['wrote_tables'] = None
+        elif info.setdefault('wrote_tables', set()) is not None:
+            info['wrote_tables'].update(tables)
+
+    def execute_cached(self, statement, params=None, tables=None, ttl=None):
+        """
+        Returns the rows of a statement as a list, from the plugin's
+        result cache when it can.  tables are the names of the tables
+        it reads, needed for textual SQL, which is run uncached without
+        them; otherwise they're found from the statement.
+        """
+        cache = self.info.get('result_cache')
+        if cache is None:
+            return self.execute(statement, params).all()
+
+        if isinstance(statement, str):
+            statement = text(statement)
+        if _loads_entities(statement):
+            # the objects belong to this session
+            return self.execute(statement, params).all()
+        if tables is None:
+            tables = _statement_tables(statement)
+        tables = tuple(sorted(tables))
+        if not tables and isinstance(statement, (TextClause, TextualSelect)):
+            # no write would invalidate it
+            return self.execute(statement, params).all()
+
+        wrote = self.info.get('wrote_tables', frozenset())
+        if wrote is None or wrote.intersection(tables):
+            # this session's own writes aren't in the cache
+            return self.execute(statement, params).all()
+
+        compiled = statement.compile(dialect=self.get_bind(clause=statement).dialect)
+        values = dict(compiled.params)
+        values.update(params or {})
+        try:
+            # an ORM select compiles to the same SQL as a Core one,
+            # but its rows are built differently
+            orm = statement._propagate_attrs.get('compile_state_plugin')
+            key = (orm, str(compiled), tuple(sorted(values.items())))
+            hash(key)
+        except TypeError:
+            return self.execute(statement, params).all()
+
+        rows = cache.get(key, tables)
+        if rows is LRUCache.MISSING:
+            versions = cache.versions(tables)
+            rows = self.execute(statement, params).all()
+            cache.put(key, versions, rows, ttl)
+        return rows
+
+    def bulk_insert(self, target, rows, batch_size=1000):
+        """
+        Inserts rows (dicts of column values) into target, a mapped class
+        or a Table, batch_size rows per executemany() rather than flushing
+        an object per row.  Returns the number of rows inserted.
+        """
+        insert = getattr(target, '__table__', target).insert()
+        rows = iter(rows)
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return count
+            self.execute(insert, batch)
+            count += len(batch)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    if 'result_cache' in session.info:
+        tables = set()
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            tables.update(table.fullname for table in object_mapper(obj).tables)
+        session._wrote_tables(tables)
+
+
+class SessionRegistry(scoped_session):
+    """scoped_session, passing on RoutingSession's extras"""
+
+    def bulk_insert(self, *args, **kwargs):
+        return self.registry().bulk_insert(*args, **kwargs)
+
+    def execute_cached(self, *args, **kwargs):
+        return self.registry().execute_cached(*args, **kwargs)
+
+
+# name -> SAEnginePlugin
+_plugins = {}
+
+def get_plugin(name):
+    """Returns the SAEnginePlugin created with this name"""
+    try:
+        return _plugins[name]
+    except KeyError:
+        raise ValueError("No SAEnginePlugin named '{}'".format(name))
 
-__all__ = ['SAEnginePlugin']
 
 class SAEnginePlugin(plugins.SimplePlugin):
-    def __init__(self, bus, connection_string=None):
+    config_prefix = 'sqlalchemy.'
+
+    def __init__(self, bus, connection_string=None, engine_options=None, stats_interval=None,
+                 replicas=None, replica_policy='round-robin', check_interval=30, name=None,
+                 query_stats=False, slow_query_time=1.0, keep_slowest=5, repeat_threshold=10,
+                 result_cache_size=0, result_cache_ttl=300):
         """
         The plugin is registered to the CherryPy engine and therefore
         is part of the bus (the engine *is* a bus) registery.
@@ -28,47 +543,247 @@ class SAEnginePlugin(plugins.SimplePlugin):
         using the mapped class of the global metadata.
         """
         plugins.SimplePlugin.__init__(self, bus)
+        self.name = name
+        if name is None:
+            self.bind_channel = 'bind-session'
+            self.commit_channel = 'commit-session'
+        else:
+            self.bind_channel = 'bind-session-' + name
+            self.commit_channel = 'commit-session-' + name
+            _plugins[name] = self
         self.sa_engine = None
         self.connection_string = connection_string
-        self.session = scoped_session(sessionmaker(autoflush=True,
-                                                   autocommit=False))
+        self.engine_options = dict(engine_options or {})
+        self.stats_interval = stats_interval
+        self.pool_stats = PoolStats()
+        self.stats_monitor = None
+        self.replica_urls = list(replicas or ())
+        self.replica_policy = replica_policy
+        self.check_interval = check_interval
+        self.slow_query_time = slow_query_time
+        self.keep_slowest = keep_slowest
+        self.repeat_threshold = repeat_threshold
+        self.query_stats = QueryStats() if query_stats else None
+        self.replicas = []
+        self._next_replica = itertools.count()
+        self.result_cache = None
+        session_info = {}
+        if result_cache_size:
+            self.result_cache = session_info['result_cache'] = ResultCache(result_cache_size,
+                                                                           result_cache_ttl)
+        self.session = SessionRegistry(sessionmaker(class_=RoutingSession,
+                                                   autoflush=True,
+                                                   autocommit=False,
+                                                   info=session_info))
+
+    def get_engine_options(self):
+        """The create_engine() options: anything in the CherryPy config
+        under config_prefix, overridden by the engine_options given to
+        the plugin.
+        """
+        options = {'echo': False}
+        named = {}
+        own_prefix = '{}{}.'.format(self.config_prefix, self.name)
+        for key, value in cherrypy.config.items():
+            if self.name is not None and key.startswith(own_prefix):
+                named[key[len(own_prefix):]] = value
+            elif key.startswith(self.config_prefix):
+                option = key[len(self.config_prefix):]
+                if '.' not in option:
+                    options[option] = value
+        options.update(named)
+        options.update(self.engine_options)
+        return options
+
+    def create_engine(self, connection_string, options, stats=None):
+        """Creates an engine whose pool checkouts are timed"""
+        if stats is None:
+            stats = self.pool_stats
+        options = dict(options)
+        poolclass = options.get('poolclass') or _default_pool_class(connection_string)
+        options['poolclass'] = _timed_pool_class(poolclass)
+        engine = create_engine(connection_string, **options)
+        engine.pool._pool_stats = stats
+        event.listen(engine, 'checkin', stats.record_checkin)
+        if self.query_stats is not None:
+            event.listen(engine, 'before_cursor_execute', self._before_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_execute)
+        return engine
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.time()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.time() - context._query_start
+        slow = seconds >= self.slow_query_time
+        self.query_stats.record(statement, seconds, slow)
+        if slow:
+            cherrypy.log('Slow query ({:.3f}s): {}'.format(seconds, statement),
+                         context='SQL', severity=logging.WARNING)
+
+        request = cherrypy.serving.request
+        if request.app is None:
+            # not in a request
+            return
+        queries = getattr(request, 'db_queries', None)
+        if queries is None:
+            queries = request.db_queries = QueryLog(self.keep_slowest)
+        if queries.record(statement, seconds) == self.repeat_threshold:
+            self.query_stats.record_repeated(statement)
+            cherrypy.log('Statement run {} times in one request for {}: {}'.format(
+                            self.repeat_threshold, request.path_info, statement),
+                         context='SQL', severity=logging.WARNING)
+
+    def create_replica(self, connection_string, options):
+        replica = Replica(None, PoolStats())
+        replica.engine = self.create_engine(connection_string, options, replica.stats)
+
+        def handle_error(context):
+            if context.is_disconnect or context.connection is None:
+                replica.mark_down()
+        event.listen(replica.engine, 'handle_error', handle_error)
+        return replica
+
+    def choose_replica(self):
+        """
+        Picks the engine for a read-only session, or None
+        for the primary if there are no replicas up.
+        """
+        up = [replica for replica in self.replicas
+              if replica.recover(self.check_interval)]
+        if not up:
+            return None
+        if self.replica_policy == 'least-checked-out':
+            return min(up, key=Replica.checkedout).engine
+        return up[next(self._next_replica) % len(up)].engine
 
     def start(self):
         self.bus.log('Starting up DB access')
-        self.sa_engine = create_engine(self.connection_string, echo=False)
-        self.bus.subscribe("bind-session", self.bind)
-        self.bus.subscribe("commit-session", self.commit)
+        options = self.get_engine_options()
+        self.sa_engine = self.create_engine(self.connection_string, options)
+        self.replicas = [self.create_replica(url, options) for url in self.replica_urls]
+        self.session.configure(bind=self.sa_engine)
+        self.bus.subscribe(self.bind_channel, self.bind)
+        self.bus.subscribe(self.commit_channel, self.commit)
+        self.bus.subscribe("db-stats", self.get_stats)
+        if self.query_stats is not None:
+            self.bus.subscribe("db-query-stats", self.get_query_stats)
+        if self.stats_interval:
+            self.stats_monitor = plugins.Monitor(self.bus, self.publish_stats,
+                                                 frequency=self.stats_interval,
+                                                 name='SAPoolStats')
+            self.stats_monitor.subscribe()
+            self.stats_monitor.start()
 
     def stop(self):
         self.bus.log('Stopping down DB access')
-        self.bus.unsubscribe("bind-session", self.bind)
-        self.bus.unsubscribe("commit-session", self.commit)
+        self.bus.unsubscribe(self.bind_channel, self.bind)
+        self.bus.unsubscribe(self.commit_channel, self.commit)
+        self.bus.unsubscribe("db-stats", self.get_stats)
+        if self.query_stats is not None:
+            self.bus.unsubscribe("db-query-stats", self.get_query_stats)
+        if self.stats_monitor:
+            self.stats_monitor.unsubscribe()
+            self.stats_monitor.stop()
+            self.stats_monitor = None
         if self.sa_engine:
             self.sa_engine.dispose()
             self.sa_engine = None
+        for replica in self.replicas:
+            replica.engine.dispose()
+        self.replicas = []
+
+    def get_stats(self):
+        """Returns the pool statistics as a dict"""
+        stats = self.pool_stats.snapshot(self.sa_engine.pool if self.sa_engine else None)
+        stats['engine'] = repr(self.sa_engine.url) if self.sa_engine else None
+        stats['name'] = self.name
+        if self.result_cache is not None:
+            stats['result_cache'] = self.result_cache.stats()
+        if self.replicas:
+            stats['replicas'] = []
+            for replica in self.replicas:
+                rstats = replica.stats.snapshot(replica.engine.pool)
+                rstats['engine'] = repr(replica.engine.url)
+                rstats['up'] = replica.up
+                stats['replicas'].append(rstats)
+        return stats
+
+    def get_query_stats(self):
+        """Returns the query statistics as a dict"""
+        stats = self.query_stats.snapshot()
+        stats['name'] = self.name
+        return stats
+
+    def publish_stats(self):
+        self.bus.publish('db-pool-stats', self.get_stats())
 
-    def bind(self):
+    def bind(self, read_only=False, autoflush=True, primary=False):
         """
         Whenever this plugin receives the 'bind-session' command, it applies
-        this method and to bind the current session to the engine.
+        this method and to bind the current session to the engine
+        (the session factory is bound when the plugin starts).
+
+        Read-only sessions are never committed, and are routed to a
+        replica if there are any, unless primary is set.  Sessions
+        without autoflush leave pending changes alone until commit
+        or an explicit flush().
 
         It then returns the session to the caller.
         """
-        self.session.configure(bind=self.sa_engine)
+        if read_only or not autoflush or self.replicas:
+            session = self.session()
+            session.autoflush = autoflush
+            info = session.info
+            info['read_only'] = read_only
+            info['primary'] = primary
+            if self.replicas:
+                info['router'] = self
         return self.session
 
     def commit(self):
         """
-        Commits the current transaction or rollbacks if an error occurs.
+        Commits the current transaction or rollbacks if an error occurs,
+        or if the session is read-only.  Cached results from the tables
+        it wrote are dropped.  Returns whether anything was written.
 
         In all cases, the current session is unbound and therefore
         not usable any longer.
         """
+        session = self.session()
+        if session.info.get('read_only'):
+            try:
+                session.rollback()
+                return False
+            finally:
+                self.session.remove()
+        wrote = bool(session.info.get('wrote') or session.new
+                     or session.dirty or session.deleted)
         try:
-            self.session.commit()
+            session.commit()
+            if self.result_cache is not None and 'wrote_tables' in session.info:
+                self.result_cache.invalidate(session.info['wrote_tables'])
+            return wrote
         except:
             self.session.rollback()
             raise
         finally:
             self.session.remove()
 
+
+def pool_status():
+    """Returns the statistics of every SAEnginePlugin on the bus"""
+    return cherrypy.engine.publish('db-stats')
+
+
+class PoolStatus(object):
+    """A handler serving pool_status() as JSON, mount it wherever
+    it's wanted, eg:
+
+        root.dbstatus = PoolStatus()
+    """
+    exposed = True
+
+    def __call__(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(pool_status(), sort_keys=True).encode('utf-8')
@@ -27,6 +27,69 @@ Then in your handler objects you can do:
 
     users = cherrypy.request.db.query(User).all()
 
+
+For handlers which only sometimes use the database, set:
+
+    tools.db.lazy = True
+
+and cherrypy.request.db will be a stand-in which only binds a session
+the first time it's used; requests which never touch it skip the
+session and the commit entirely.
+
+Handlers which only read can say so, and their session is then rolled
+back at the end of the request rather than committed, and its queries
+are sent to SAEnginePlugin's replicas if it has any:
+
+    tools.db.read_only = True
+
+or with the tool as a decorator:
+
+    @cherrypy.tools.db(read_only=True)
+    def index(self):
+        ...
+
+With sessions on, setting tools.db.sticky to a number of seconds sends
+a client's read-only requests to the primary for that long after one
+of its requests writes, so it reads what it just wrote.  Those
+requests' sessions are always lazy, so the client's session can be
+checked on first use; one used before the sessions tool has locked
+the client's session, by an earlier tool, goes to the primary.
+
+Handlers which add a lot of objects can turn off autoflush, so that
+queries don't flush everything pending before they run:
+
+    tools.db.autoflush = False
+
+and for plain rows, cherrypy.request.db.bulk_insert() inserts them in
+batches with executemany():
+
+    cherrypy.request.db.bulk_insert(Event, ({'kind': e.kind, 'at': e.at}
+                                            for e in events))
+
+If the plugin has a result cache, cherrypy.request.db.execute_cached()
+returns rows from it; see pycrust.saplugin.
+
+By default the tool reaches the plugin through the bus, publishing
+'bind-session' and 'commit-session' on every request, which only an
+unnamed plugin listens on.  Give it the plugin, or the name it was
+created with, to call it directly:
+
+    db = SAEnginePlugin(cherrypy.engine, "sqlite:///database.db", name='main')
+    db.subscribe()
+    cherrypy.tools.db = SATool(db)      # or SATool('main')
+
+For several databases, give it a list of named plugins (or their
+names), and cherrypy.request.db becomes a mapping of name to session,
+each bound the first time it's looked up:
+
+    cherrypy.tools.db = SATool(['accounts', 'events'])
+
+    ...
+
+    user = cherrypy.request.db['accounts'].query(User).get(uid)
+
+Only the sessions a request actually used are committed.
+
 """
 #
 # This file is based on Sylvain Hellegouarch's post:
@@ -34,12 +97,76 @@ Then in your handler objects you can do:
 #
 # All credit goes to Sylvain for this.
 #
+import time
+
 import cherrypy
 
-__all__ = ['SATool']
+__all__ = ['SATool', 'LazySession', 'Databases']
+
+
+class LazySession(object):
+    """
+    Stands in for the request's session, binding the real
+    one on first use.
+    """
+    __slots__ = ('_session', '_bind', '_policy')
+
+    def __init__(self, bind, policy):
+        self._session = None
+        self._bind = bind
+        self._policy = policy
+
+    @property
+    def materialized(self):
+        return self._session is not None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = self._bind(**self._policy)
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self._get_session(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._get_session()(*args, **kwargs)
+
+    def __contains__(self, instance):
+        return instance in self._get_session()
+
+    def __iter__(self):
+        return iter(self._get_session())
+
+
+class Databases(object):
+    """
+    The request's sessions when the tool has several databases,
+    each bound the first time it's looked up.
+    """
+
+    def __init__(self, tool, policy, open_session=None):
+        self.tool = tool
+        self.policy = policy
+        self.open_session = open_session or tool.open_session
+        self.sessions = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.sessions[name]
+        except KeyError:
+            session = self.open_session(name, **self.policy)
+            self.sessions[name] = session
+            return session
+
+    def __contains__(self, name):
+        return name in self.tool.get_plugins()
+
+    def __iter__(self):
+        return iter(self.tool.get_plugins())
+
 
 class SATool(cherrypy.Tool):
-    def __init__(self):
+    def __init__(self, plugin=None):
         """
         The SA tool is responsible for associating a SA session
         to the SA engine and attaching it to the current request.
@@ -51,33 +178,167 @@ class SATool(cherrypy.Tool):
         This tools binds a session to the engine each time
         a requests starts and commits/rollbacks whenever
         the request terminates.
+
+        plugin is the SAEnginePlugin to use, or its name; without
+        it the plugin is reached through the bus.  A list of them
+        makes request.db a Databases mapping.
         """
+        self.plugin = plugin
+        self._plugin = None
+        self._plugins = None
         cherrypy.Tool.__init__(self, 'on_start_resource',
                                self.bind_session,
                                priority=20)
 
+    sticky_key = '_db_primary_until'
+
     def _setup(self):
         cherrypy.Tool._setup(self)
+        conf = self._merged_args()
+        sticky = conf.get('sticky', 0)
+        if sticky:
+            # commit before the sessions tool saves the client's
+            # session at before_finalize, so the write is recorded
+            cherrypy.request.hooks.attach('before_finalize',
+                                          self.commit_transaction,
+                                          priority=40, sticky=sticky)
         cherrypy.request.hooks.attach('on_end_resource',
                                       self.commit_transaction,
-                                      priority=80)
+                                      priority=80, sticky=sticky)
+        # a streamed body is still being read from the session until
+        # it has been written out; this runs before the sessions tool
+        # saves a streamed response's client session
+        cherrypy.request.hooks.attach('on_end_request',
+                                      self.commit_transaction,
+                                      priority=40, sticky=sticky, streamed=True)
+
+    @property
+    def multiple(self):
+        return isinstance(self.plugin, (list, tuple))
+
+    @staticmethod
+    def _resolve(plugin):
+        if isinstance(plugin, str):
+            from pycrust.saplugin import get_plugin
+            return get_plugin(plugin)
+        return plugin
+
+    def get_plugins(self):
+        """name -> plugin, for a tool with several databases"""
+        if self._plugins is None:
+            plugins = [self._resolve(plugin) for plugin in self.plugin]
+            self._plugins = dict((plugin.name, plugin) for plugin in plugins)
+        return self._plugins
 
-    def bind_session(self):
+    def get_plugin(self, name=None):
+        """The plugin to call directly, or None to use the bus"""
+        if name is not None:
+            try:
+                return self.get_plugins()[name]
+            except KeyError:
+                raise KeyError("No database named '{}' for this tool".format(name))
+        if self._plugin is None and self.plugin is not None:
+            self._plugin = self._resolve(self.plugin)
+        return self._plugin
+
+    def open_session(self, name=None, **policy):
+        """Binds a session, see SAEnginePlugin.bind() for the policy"""
+        plugin = self.get_plugin(name)
+        if plugin is None:
+            return cherrypy.engine.publish('bind-session', **policy).pop()
+        return plugin.bind(**policy)
+
+    def close_session(self, name=None):
+        """Commits the plugin's session, returns whether it wrote anything"""
+        plugin = self.get_plugin(name)
+        if plugin is None:
+            return any(cherrypy.engine.publish('commit-session'))
+        return plugin.commit()
+
+    def _client_session(self):
+        """The client's HTTP session, if sessions are on"""
+        if cherrypy.request.config.get('tools.sessions.on'):
+            return cherrypy.session
+        return None
+
+    def bind_session(self, lazy=False, read_only=False, sticky=0, autoflush=True):
         """
         Attaches a session to the request's scope by requesting
         the SA plugin to bind a session to the SA engine.
+        If lazy, this is put off until the session is first used.
         """
-        session = cherrypy.engine.publish('bind-session').pop()
-        cherrypy.request.db = session
+        policy = {'read_only': read_only, 'autoflush': autoflush}
+        if read_only and sticky:
+            # the client's session isn't loaded yet, so this
+            # is decided when the session is first used
+            self._bind(True, policy, self.open_sticky_session)
+            return
+        self._bind(lazy, policy)
 
-    def commit_transaction(self):
+    def open_sticky_session(self, name=None, **policy):
+        """
+        Binds a read-only session, on the primary if this client
+        has written recently, or if its session can't be read yet.
+        """
+        client = self._client_session()
+        if client is None:
+            policy['primary'] = False
+        elif not client.loaded and not client.locked:
+            # some storage can't be loaded before the sessions
+            # tool locks it, at before_handler
+            policy['primary'] = True
+        else:
+            policy['primary'] = client.get(self.sticky_key, 0) > time.time()
+        return self.open_session(name, **policy)
+
+    def _bind(self, lazy, policy, open_session=None):
+        open_session = open_session or self.open_session
+        if self.multiple:
+            cherrypy.request.db = Databases(self, policy, open_session)
+            return
+        if lazy:
+            cherrypy.request.db = LazySession(open_session, policy)
+            return
+        cherrypy.request.db = open_session(**policy)
+
+    def commit_transaction(self, sticky=0, streamed=False):
         """
         Commits the current transaction or rolls back
         if an error occurs. Removes the session handle
-        from the request's scope.
+        from the request's scope.  For a streamed response
+        this waits until the body has been sent.
         """
-        if not hasattr(cherrypy.request, 'db'):
+        db = getattr(cherrypy.request, 'db', None)
+        if db is None:
+            return
+        if cherrypy.response.stream and not streamed:
             return
         cherrypy.request.db = None
-        cherrypy.engine.publish('commit-session')
+        if isinstance(db, LazySession) and not db.materialized:
+            return
+        if isinstance(db, Databases):
+            wrote = self.close_sessions(db.sessions)
+        else:
+            wrote = self.close_session()
+        if wrote and sticky:
+            client = self._client_session()
+            if client is not None:
+                client[self.sticky_key] = time.time() + sticky
 
+    def close_sessions(self, names):
+        """
+        Commits each of the named databases' sessions, carrying on
+        past any that fail so they're all removed.  Returns whether
+        any of them wrote anything.
+        """
+        wrote = False
+        error = None
+        for name in names:
+            try:
+                wrote = self.close_session(name) or wrote
+            except Exception as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return wrote
@@ -11,50 +11,179 @@ This method uses a custom encoder, and calls obj.__to_json__() or
 obj.__to_dict__() on any object which has this method.  This method
 should return the data in the object as a dict.
 
+Use it with CherryPy's json_out tool:
+
+    tools.json_out.on = True
+    tools.json_out.handler = pycrust.tools.json_handler
+
+The output can be tuned per handler with these config keys:
+
+    json.sort_keys = False      # default True
+    json.backend = 'orjson'     # default 'json'
+
+The backends are 'json' (simplejson if it's installed, or the standard
+library), and 'orjson' if it's installed, which is much faster; 'auto'
+picks orjson when it can.  orjson's output isn't the same, so it has
+to be asked for:
+
+  * it is compact, and UTF-8 rather than ASCII-escaped
+  * it writes NaN and Infinity as null rather than refusing them
+  * it serializes UUIDs and dataclasses itself
+
+Values it can't encode, like integers too big for 64 bits, are handed
+to the 'json' backend instead.  orjson writes bytes directly, while
+the 'json' backend still builds a str and encodes it to UTF-8.
+
+Handlers which return a generator or other iterator have their output
+streamed (with response.stream) as a JSON array, encoded a batch of
+items at a time, so the whole result is never held in memory.  For
+other iterables, like a SQLAlchemy query with yield_per(), set
+json.stream = True; json.stream = False turns streaming off.  These
+config keys control it:
+
+    json.stream_format = 'ndjson'   # default 'array'
+    json.stream_batch = 500         # items per chunk, default 100
+
+'ndjson' is newline-delimited JSON, one item per line, sent as
+application/x-ndjson.  Once streaming has begun an error can't change
+the status any more, so the response is just cut short.
 
 """
 
 __author__ = 'Michael Stella <pycrust@thismetalsky.org>'
 
 import datetime
-import sys
+import itertools
 
 import cherrypy
 try:
     import simplejson as json
 except ImportError:
     import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from pycrust import url
 
 #### JSON Output ####
 
-def json_handler(*args, **kwargs):
-    """Custom JSON handler which uses the custom encoder"""
-    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+def json_default(obj):
+    """Converts the objects JSON can't handle by itself"""
+    if hasattr(obj, '__to_json__'):
+        return obj.__to_json__()
+    if hasattr(obj, '__to_dict__'):
+        return obj.__to_dict__()
 
-    # optionally set indent=4 here
-    out = json.dumps(value, sort_keys=True, cls=JSONCustomEncoder, allow_nan=False)
+    # we convert dates into ISO format, it's reasonably portable
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
 
-    # Cherrypy wants us to return bytes, so in Python 3 we have to
-    # encode the JSON output properly
-    if sys.version < '3':
-        return out
-    else:
-        return bytes(out , 'utf-8')
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
 
 
 class JSONCustomEncoder(json.JSONEncoder):
     """Custom JSON encoder class"""
     def default(self, obj):
-        if hasattr(obj, '__to_json__'):
-            return obj.__to_json__()
-        if hasattr(obj, '__to_dict__'):
-            return obj.__to_dict__()
+        return json_default(obj)
+
+
+# one encoder each way, rather than a new one per response
+_json_encoders = {
+    True:   JSONCustomEncoder(sort_keys=True, allow_nan=False),
+    False:  JSONCustomEncoder(sort_keys=False, allow_nan=False),
+}
+
+def _encode_json(value, sort_keys=True):
+    return _json_encoders[sort_keys].encode(value).encode('utf-8')
+
+# the names of the available backends, and a function for each
+# which encodes a value to bytes
+json_backends = {'json': _encode_json}
+
+if orjson is not None:
+    _orjson_options = {
+        True:   orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS,
+        False:  orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+    }
+
+    def _encode_orjson(value, sort_keys=True):
+        try:
+            return orjson.dumps(value, default=json_default, option=_orjson_options[sort_keys])
+        except orjson.JSONEncodeError:
+            # eg. integers over 64 bits, which json handles
+            return _encode_json(value, sort_keys)
+
+    json_backends['orjson'] = _encode_orjson
+
+
+def get_json_encoder(backend='json'):
+    """Returns the encoding function for a backend"""
+    if backend == 'auto':
+        backend = 'orjson' if 'orjson' in json_backends else 'json'
+    try:
+        return json_backends[backend]
+    except KeyError:
+        raise ValueError("JSON backend '{}' isn't available".format(backend))
+
+
+def json_encode(value, sort_keys=True, backend='json'):
+    """Encodes a value as JSON bytes, the way json_handler does"""
+    return get_json_encoder(backend)(value, sort_keys)
+
+
+def json_stream(items, sort_keys=True, backend='json', format='array', batch=100):
+    """
+    Encodes an iterable as a JSON array, or as newline-delimited JSON,
+    yielding bytes a batch of items at a time.
+    """
+    encode = get_json_encoder(backend)
+    items = iter(items)
+    if format == 'ndjson':
+        while True:
+            chunk = list(itertools.islice(items, batch))
+            if not chunk:
+                return
+            yield b''.join([encode(item, sort_keys) + b'\n' for item in chunk])
+    elif format == 'array':
+        separator = b'['
+        while True:
+            chunk = list(itertools.islice(items, batch))
+            if not chunk:
+                break
+            # encode the batch as a list, and drop its brackets
+            yield separator + encode(chunk, sort_keys)[1:-1]
+            separator = b','
+        yield b'[]' if separator == b'[' else b']'
+    else:
+        raise ValueError("Unknown JSON stream format '{}'".format(format))
+
 
-        # we convert dates into ISO format, it's reasonably portable
-        if isinstance(obj, (datetime.date, datetime.datetime)):
-            return obj.isoformat()
+def _should_stream(value, stream):
+    if stream is False or isinstance(value, (dict, list, tuple, str, bytes)):
+        return False
+    if stream:
+        return hasattr(value, '__iter__')
+    return hasattr(value, '__next__')
 
-        return json.JSONEncoder.default(self, obj)
 
+def json_handler(*args, **kwargs):
+    """Custom JSON handler which uses the custom encoder"""
+    request = cherrypy.serving.request
+    value = request._json_inner_handler(*args, **kwargs)
+
+    config = request.config
+    sort_keys = config.get('json.sort_keys', True)
+    backend = config.get('json.backend', 'json')
+
+    if _should_stream(value, config.get('json.stream')):
+        response = cherrypy.serving.response
+        format = config.get('json.stream_format', 'array')
+        if format == 'ndjson':
+            response.headers['Content-Type'] = 'application/x-ndjson'
+        response.stream = True
+        return json_stream(value, sort_keys, backend, format,
+                           config.get('json.stream_batch', 100))
+
+    return json_encode(value, sort_keys, backend)
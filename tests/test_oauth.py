@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from pycrust import oauth
+
+
+class NonceDataStore(oauth.OAuthDataStore):
+    """Remembers every nonce it's asked about"""
+
+    def __init__(self):
+        self.nonces = set()
+
+    def lookup_nonce(self, oauth_consumer, oauth_token, nonce):
+        if nonce in self.nonces:
+            return nonce
+        self.nonces.add(nonce)
+
+
+class SharedNonceStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data_store = NonceDataStore()
+        self.store = oauth.SharedNonceStore(self.data_store, os.path.join(self.dir, 'nonces'),
+                                            slots=1, window=10)
+        self.consumer = oauth.OAuthConsumer('key', 'secret')
+        self.now = 1000000
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def lookup(self, nonce, at):
+        with mock.patch('time.time', return_value=self.now + at):
+            return self.store.lookup_nonce(self.consumer, None, nonce)
+
+    def test_replay(self):
+        self.assertIsNone(self.lookup('a', 0))
+        self.assertEqual(self.lookup('a', 5), 'a')
+        self.assertIsNone(self.lookup('a', 11))
+
+    def test_replay_after_overflow(self):
+        self.assertIsNone(self.lookup('a', 0))
+        # the table is full, so this goes to the data store
+        self.assertIsNone(self.lookup('b', 5))
+        self.assertEqual(self.store.nonce_stats()['overflows'], 1)
+        # a's slot is free again, but b is still within the window
+        self.assertEqual(self.lookup('b', 11), 'b')
+
+    def test_overflow_expires(self):
+        self.assertIsNone(self.lookup('a', 0))
+        self.assertIsNone(self.lookup('b', 5))
+        self.data_store.nonces.clear()
+        # once b has expired, the table alone is used again
+        self.assertIsNone(self.lookup('c', 16))
+        self.assertEqual(self.data_store.nonces, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
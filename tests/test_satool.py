@@ -0,0 +1,139 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import wsgiref.util
+
+import cherrypy
+from sqlalchemy import create_engine, text
+
+from pycrust.saplugin import SAEnginePlugin
+from pycrust.satool import SATool
+
+
+def wsgi_get(path, cookie=None):
+    """Sends one request through cherrypy.tree, returns the status,
+    the session cookie and the body.
+    """
+    environ = {
+        'REQUEST_METHOD':   'GET',
+        'PATH_INFO':        path,
+        'HTTP_HOST':        'localhost',
+        'wsgi.input':       io.BytesIO(),
+    }
+    if cookie:
+        environ['HTTP_COOKIE'] = cookie
+    wsgiref.util.setup_testing_defaults(environ)
+
+    started = []
+    response = cherrypy.tree(environ, lambda s, h, e=None: started.append((s, h)))
+    try:
+        body = b''.join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    status, headers = started[0]
+    for name, value in headers:
+        if name.lower() == 'set-cookie':
+            cookie = value.split(';', 1)[0]
+    return status, cookie, body.decode('utf-8')
+
+
+def read_early():
+    cherrypy.request.early = cherrypy.request.db.execute(text('SELECT name FROM t')).scalar()
+
+cherrypy.tools.read_early = cherrypy.Tool('before_handler', read_early, priority=10)
+
+
+class Root(object):
+    @cherrypy.expose
+    def write(self):
+        cherrypy.request.db.execute(text("INSERT INTO t VALUES ('written')"))
+        return 'ok'
+
+    @cherrypy.expose
+    def read(self):
+        return cherrypy.request.db.execute(text('SELECT name FROM t')).scalar()
+
+    @cherrypy.expose
+    @cherrypy.tools.read_early()
+    def early(self):
+        return cherrypy.request.early
+
+
+class StickyTest(unittest.TestCase):
+    """A client's reads go to the primary after it writes."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        urls = []
+        for name in ('primary', 'replica'):
+            url = 'sqlite:///' + os.path.join(cls.dir, name + '.db')
+            engine = create_engine(url)
+            with engine.begin() as conn:
+                conn.execute(text('CREATE TABLE t (name TEXT)'))
+                conn.execute(text('INSERT INTO t VALUES (:name)'), {'name': name})
+            engine.dispose()
+            urls.append(url)
+
+        cherrypy.config.update({'environment': 'embedded', 'log.screen': False})
+        cls.plugin = SAEnginePlugin(cherrypy.engine, urls[0], replicas=urls[1:],
+                                    engine_options={'connect_args': {'check_same_thread': False}})
+        cls.plugin.start()
+        cherrypy.tools.db_sticky = SATool(cls.plugin)
+
+        conf = {'tools.db_sticky.on': True,
+                'tools.db_sticky.sticky': 60,
+                'tools.sessions.on': True}
+        read = {'tools.db_sticky.read_only': True}
+        cherrypy.tree.mount(Root(), '/ram', {'/': conf, '/read': read, '/early': read})
+        cherrypy.tree.mount(Root(), '/file', {'/': dict(conf, **{
+            'tools.sessions.storage_class': cherrypy.lib.sessions.FileSession,
+            'tools.sessions.storage_path': cls.dir}), '/read': read, '/early': read})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.plugin.stop()
+        for script_name in ('/ram', '/file'):
+            del cherrypy.tree.apps[script_name]
+        shutil.rmtree(cls.dir)
+
+    def check_sticky(self, prefix):
+        status, cookie, body = wsgi_get(prefix + '/read')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, 'replica')
+
+        status, cookie, body = wsgi_get(prefix + '/write', cookie)
+        self.assertEqual(status, '200 OK')
+
+        status, cookie, body = wsgi_get(prefix + '/read', cookie)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, 'primary')
+
+        # other clients still read from the replica
+        status, other, body = wsgi_get(prefix + '/read')
+        self.assertEqual(body, 'replica')
+
+    def check_early(self, prefix):
+        # before the client's session is locked, it can't tell
+        status, cookie, body = wsgi_get(prefix + '/early')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, 'primary')
+
+    def test_ram_sessions(self):
+        self.check_sticky('/ram')
+
+    def test_file_sessions(self):
+        self.check_sticky('/file')
+
+    def test_ram_sessions_early(self):
+        self.check_early('/ram')
+
+    def test_file_sessions_early(self):
+        self.check_early('/file')
+
+
+if __name__ == '__main__':
+    unittest.main()